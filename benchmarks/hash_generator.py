@@ -0,0 +1,88 @@
+# Micro-benchmark for ModelHashGenerator
+#
+# Measures the cost of generating one hash, the old way (a new
+# HMAC and repr() of the arguments every time) against the
+# current way (SHA-256 states keyed once per secret and copied,
+# and the canonical argument encoding), both for single hashes
+# and for several candidates where the arguments are prepared
+# once per record.
+#
+# No database is involved, so this doesn't need Django
+# settings; run it from the top of the repository:
+#
+#   python benchmarks/hash_generator.py [count]
+#
+import base64
+import datetime
+import decimal
+import hashlib
+import hmac
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sculpt.model_tools.hash_generator import ModelHashGenerator
+
+SECRET = 'benchmark-secret-benchmark-secret'
+
+# typical AUTOHASH_FIELDS values, plus the timestamp that
+# AutoHashMixin adds
+ARGS = [ u'someone@example.com', u'Someone Example', 42, decimal.Decimal('19.99'), datetime.datetime(2015, 6, 1, 12, 30, 0) ]
+
+# the way generate_hash_core used to work
+def old_generate_hash_core(counter, hashkey, *args):
+    raw_hash = hmac.new(hashkey, repr(args) + str(counter), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(raw_hash)[:43]
+
+def old_single():
+    old_generate_hash_core(1, SECRET, *ARGS)
+
+def new_single():
+    ModelHashGenerator.generate_hash_core(1, SECRET, *ARGS)
+
+# records, which repr() can't encode reliably
+class Record(object):
+    class _meta(object):
+        app_label = 'shop'
+        model_name = 'order'
+    _meta.concrete_model = None
+    pk = 1234
+Record._meta.concrete_model = Record
+
+def new_single_record():
+    ModelHashGenerator.generate_hash_core(1, SECRET, Record(), *ARGS)
+
+def new_encode_only():
+    ModelHashGenerator.encode_args(ARGS)
+
+def old_encode_only():
+    repr(ARGS)
+
+# three candidates for one record, as when a batch has to go
+# around again after collisions
+def old_retries():
+    for counter in (1, 2, 3):
+        old_generate_hash_core(counter, SECRET, *ARGS)
+
+def new_retries():
+    prepared = ModelHashGenerator.prepare_hash(SECRET, *ARGS)
+    for counter in (1, 2, 3):
+        ModelHashGenerator.finish_hash(prepared, counter)
+
+def report(label, func, count):
+    best = min(timeit.repeat(func, number = count, repeat = 3))
+    print '%-32s %8.2f us per call' % (label, best / count * 1000000.0)
+
+if __name__ == '__main__':
+    assert old_generate_hash_core(1, SECRET, *ARGS) == ModelHashGenerator.generate_hash_core(1, SECRET, *ARGS)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print 'ModelHashGenerator, best of 3 x %d calls' % count
+    report('encode: repr(args)', old_encode_only, count)
+    report('encode: encode_args', new_encode_only, count)
+    report('one hash: old', old_single, count)
+    report('one hash: new', new_single, count)
+    report('one hash with a record: new', new_single_record, count)
+    report('three candidates: old', old_retries, count)
+    report('three candidates: new', new_retries, count)
@@ -0,0 +1,61 @@
+import sqlite3
+
+# Database feature checks
+#
+# Django's connection.features describes the things Django
+# itself needs to know about a database, which doesn't cover
+# the more modern SQL we'd like to use when it's available.
+# These checks let the tools decide whether to hand work to
+# the database or fall back to doing it the slow way.
+#
+# NOTE: MySQL jumped from 5.7 to 8.0, and MariaDB (which
+# reports its own version through the same call) started at
+# 10.0, so a version of 8.x is MySQL 8 and anything from 10.2
+# on is a MariaDB that has caught up on the same features.
+#
+
+# window functions, e.g. ROW_NUMBER() OVER (PARTITION BY ...)
+def supports_window_functions(connection):
+    return _supports_modern_sql(connection, sqlite_version = (3, 25, 0))
+
+# common table expressions, including WITH RECURSIVE
+#
+# NOTE: Oracle has recursive queries, but doesn't accept the
+# RECURSIVE keyword or a plain UNION in them (ORA-32040), and
+# the tree walks rely on UNION to stop at cycles, so Oracle
+# gets the fallback.
+#
+def supports_recursive_cte(connection):
+    if connection.vendor == 'oracle':
+        return False
+    return _supports_modern_sql(connection, sqlite_version = (3, 8, 3))
+
+def _supports_modern_sql(connection, sqlite_version):
+    vendor = connection.vendor
+    if vendor in ('postgresql', 'oracle'):
+        return True
+    elif vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= sqlite_version
+    elif vendor == 'mysql':
+        version = connection.mysql_version
+        return (8, 0) <= version < (10, 0) or version >= (10, 2)
+    else:
+        return False
+
+# native "insert or update" statements; returns the flavor of
+# SQL to use, or None if we have to do it the ORM way
+#
+#   postgresql - INSERT ... ON CONFLICT ... DO UPDATE (9.5+)
+#   sqlite - INSERT ... ON CONFLICT ... DO NOTHING (3.24+)
+#   mysql - INSERT ... ON DUPLICATE KEY UPDATE
+#
+def get_upsert_dialect(connection):
+    vendor = connection.vendor
+    if vendor == 'postgresql' and connection.pg_version >= 90500:
+        return 'postgresql'
+    elif vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24, 0):
+        return 'sqlite'
+    elif vendor == 'mysql':
+        return 'mysql'
+    else:
+        return None
@@ -4,6 +4,7 @@ from django.contrib.auth.models import AbstractBaseUser
 from django.utils import timezone
 
 from sculpt.common import Enumeration
+from sculpt.model_tools.hash_cache import get_hash_cache
 from sculpt.model_tools.mixins import AutoHashMixin
 
 # AbstractAutoHash
@@ -13,6 +14,33 @@ from sculpt.model_tools.mixins import AutoHashMixin
 # hash field, but expects the application to do so;
 # this is the minimum required for that to function.
 #
+# It also remembers which record each hash belongs to (see
+# HashCache), so that when only the ID is needed, looking up
+# the hash in a URL takes no query at all:
+#
+#   get_by_hash - the record with a hash (raises DoesNotExist)
+#   get_pk_for_hash - just its ID, or None
+#   resolve_hashes - records for a whole list of hashes, as a
+#       dictionary of hash to record, in one query
+#
+# Only get_pk_for_hash and resolve_hashes use the cache.
+# Fetching a whole record by ID costs the same as fetching it
+# by hash (the hash has a unique index), so get_by_hash just
+# does the latter.
+#
+# Optional settings, on the model class:
+#
+#   AUTOHASH_CACHE_SIZE - how many hashes to keep in each
+#       process (default: 1000)
+#
+#   AUTOHASH_CACHE_BACKEND - the alias of a Django cache
+#       (from settings.CACHES) to share entries between
+#       processes (default: None, this process only)
+#
+#   AUTOHASH_CACHE_TIMEOUT - expiry, in seconds, for entries
+#       in the shared cache (default: None, never; a hash
+#       never changes once assigned)
+#
 class AbstractAutoHash(AutoHashMixin, models.Model):
     class Meta(object):
         abstract = True
@@ -23,6 +51,85 @@ class AbstractAutoHash(AutoHashMixin, models.Model):
 
     hash = models.CharField(max_length = 43, unique = True, blank = True, null = True) 
 
+    @classmethod
+    def get_by_hash(cls, hash):
+        return cls.objects.get(hash = hash)
+
+    # NOTE: on a cache hit this does no query at all, so the ID
+    # may belong to a record that has since been deleted with
+    # QuerySet.delete(); use get_by_hash if that matters
+    @classmethod
+    def get_pk_for_hash(cls, hash):
+        hash_cache = get_hash_cache(cls)
+        pk = hash_cache.get(hash)
+        if pk is None:
+            pks = list(cls.objects.filter(hash = hash).values_list('pk', flat = True)[:1])
+            if len(pks) == 0:
+                return None
+            pk = pks[0]
+            hash_cache.set(hash, pk)
+        return pk
+
+    # hashes that don't match a record are left out of the
+    # results
+    @classmethod
+    def resolve_hashes(cls, hashes):
+        hashes = set([ h for h in hashes if h ])
+        if len(hashes) == 0:
+            return {}
+
+        # the ones we know go by ID, the rest by hash, but
+        # both in the same query; matching on hash afterwards
+        # weeds out any stale IDs
+        hash_cache = get_hash_cache(cls)
+        known = hash_cache.get_many(hashes)
+        unknown = hashes - set(known.iterkeys())
+        results = {}
+        for record in cls.objects.filter(Q(pk__in = known.values()) | Q(hash__in = list(unknown))):
+            if record.hash in hashes:
+                results[record.hash] = record
+
+        # forget stale entries and learn new ones
+        for hash in known.iterkeys():
+            if hash not in results:
+                hash_cache.delete(hash)
+        hash_cache.set_many(dict([ (hash, results[hash].pk) for hash in unknown if hash in results ]))
+
+        # a stale entry may hide a record that does exist under
+        # that hash, so look those up by hash after all
+        stale = [ hash for hash in known.iterkeys() if hash not in results ]
+        if len(stale) > 0:
+            for record in cls.objects.filter(hash__in = stale):
+                results[record.hash] = record
+                hash_cache.set(record.hash, record.pk)
+
+        return results
+
+    def __init__(self, *args, **kwargs):
+        super(AbstractAutoHash, self).__init__(*args, **kwargs)
+        # the hash as last saved, so save() only tells the cache
+        # about new ones (a deferred hash counts as unknown)
+        self._saved_hash = self.__dict__.get('hash')
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        result = super(AbstractAutoHash, self).save(*args, **kwargs)
+        if adding or self.hash != self._saved_hash:
+            hash_cache = get_hash_cache(self.__class__)
+            if self._saved_hash and self._saved_hash != self.hash:
+                hash_cache.delete(self._saved_hash)
+            if self.hash:
+                hash_cache.set(self.hash, self.pk)
+        self._saved_hash = self.hash
+        return result
+
+    def delete(self, *args, **kwargs):
+        hash = self.hash
+        result = super(AbstractAutoHash, self).delete(*args, **kwargs)
+        if hash:
+            get_hash_cache(self.__class__).delete(hash)
+        return result
+
 
 # AbstractSoftDelete
 #
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+import threading
+
+# HashCache
+#
+# Views that take an auto-hash from the URL (see
+# AUTOHASH_URL_PATTERN) start every request by looking the
+# hash up. A hash never changes once it's assigned, so the
+# hash-to-ID mapping is an ideal thing to cache; this is that
+# cache, one per model.
+#
+# Entries are kept in an in-process LRU of at most max_size
+# hashes. If a Django cache is given (by alias, as in
+# settings.CACHES) it is consulted on a local miss and written
+# through on every change, so that all processes can share
+# what any one of them has learned.
+#
+# NOTE: the cache can't see records deleted with
+# QuerySet.delete() or changed with QuerySet.update(), so
+# anything that fetches a record through it must check the
+# record's hash (AbstractAutoHash does) and not trust a bare
+# ID for anything that matters.
+#
+class HashCache(object):
+
+    def __init__(self, model_class, max_size = 1000, backend = None, timeout = None):
+        self.model = model_class
+        self.max_size = max_size
+        self.backend = backend
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_prefix = 'sculpt.hash:%s.%s:' % (model_class._meta.app_label, model_class._meta.model_name)
+
+    # the cached ID for a hash, or None
+    def get(self, hash):
+        with self._lock:
+            pk = self._entries.pop(hash, None)
+            if pk is not None:
+                # move it to the most-recently-used end
+                self._entries[hash] = pk
+                return pk
+
+        if self.backend is not None:
+            pk = self._get_backend().get(self._key_prefix + hash)
+            if pk is not None:
+                self._set_local(hash, pk)
+            return pk
+        return None
+
+    # the cached IDs for a list of hashes, as a dictionary;
+    # hashes we don't know are left out
+    def get_many(self, hashes):
+        results = {}
+        missing = []
+        with self._lock:
+            for hash in hashes:
+                pk = self._entries.pop(hash, None)
+                if pk is not None:
+                    self._entries[hash] = pk
+                    results[hash] = pk
+                else:
+                    missing.append(hash)
+
+        if self.backend is not None and len(missing) > 0:
+            found = self._get_backend().get_many([ self._key_prefix + hash for hash in missing ])
+            prefix_length = len(self._key_prefix)
+            for key, pk in found.iteritems():
+                results[key[prefix_length:]] = pk
+                self._set_local(key[prefix_length:], pk)
+        return results
+
+    def set(self, hash, pk):
+        self._set_local(hash, pk)
+        if self.backend is not None:
+            self._get_backend().set(self._key_prefix + hash, pk, self.timeout)
+
+    def set_many(self, entries):
+        for hash, pk in entries.iteritems():
+            self._set_local(hash, pk)
+        if self.backend is not None and len(entries) > 0:
+            self._get_backend().set_many(dict([ (self._key_prefix + hash, pk) for hash, pk in entries.iteritems() ]), self.timeout)
+
+    def delete(self, hash):
+        with self._lock:
+            self._entries.pop(hash, None)
+        if self.backend is not None:
+            self._get_backend().delete(self._key_prefix + hash)
+
+    # forget everything held in this process (the shared cache,
+    # if any, is left alone)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _set_local(self, hash, pk):
+        with self._lock:
+            self._entries.pop(hash, None)
+            self._entries[hash] = pk
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+
+    def _get_backend(self):
+        from django.core.cache import caches
+        return caches[self.backend]
+
+
+# the HashCache for each model, created on first use
+_hash_caches = {}
+_hash_caches_lock = threading.Lock()
+
+def get_hash_cache(model_class):
+    model_class = model_class._meta.concrete_model
+    hash_cache = _hash_caches.get(model_class)
+    if hash_cache is None:
+        with _hash_caches_lock:
+            hash_cache = _hash_caches.get(model_class)
+            if hash_cache is None:
+                hash_cache = HashCache(
+                        model_class,
+                        max_size = getattr(model_class, 'AUTOHASH_CACHE_SIZE', 1000),
+                        backend = getattr(model_class, 'AUTOHASH_CACHE_BACKEND', None),
+                        timeout = getattr(model_class, 'AUTOHASH_CACHE_TIMEOUT', None),
+                    )
+                _hash_caches[model_class] = hash_cache
+    return hash_cache
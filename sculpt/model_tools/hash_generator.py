@@ -1,20 +1,21 @@
 import base64
+import datetime
+import decimal
 import hashlib
 import hmac
 import numbers
 
+# the keyed inner and outer SHA-256 states of the HMAC for
+# each secret, ready to be copied; see ModelHashGenerator.
+# prepare_hash
+_prepared_hmacs = {}
+
 # Create a Hash given a list of items
 class ModelHashGenerator(object):
 
     @classmethod
     def generate_hash(klass, cls, hashkey, *args):       
-        counter = 0
-        while True:
-            counter += 1
-            encoded_hash = klass.generate_hash_core(counter, hashkey, *args)
-            if encoded_hash[0] in '-_':
-                # we don't want user hashes that start with these
-                continue
+        for encoded_hash in klass.candidate_hashes(hashkey, *args):
             if cls.objects.filter(hash = encoded_hash).count() > 0:
                 # this hash is already in use
                 continue
@@ -22,9 +23,228 @@ class ModelHashGenerator(object):
             # otherwise the hash is acceptable
             return encoded_hash
 
+    # the hashes generate_hash would try, in order, without
+    # checking the database; for callers that find out about
+    # collisions some other way (see AUTOHASH_OPTIMISTIC)
+    @classmethod
+    def candidate_hashes(klass, hashkey, *args):
+        prepared = klass.prepare_hash(hashkey, *args)
+        counter = 0
+        while True:
+            counter += 1
+            encoded_hash = klass.finish_hash(prepared, counter)
+            if encoded_hash[0] in '-_':
+                # we don't want user hashes that start with these
+                continue
+            yield encoded_hash
+
+    # generate_hash for a whole batch of records at once; takes
+    # a list of argument lists (one per record) and returns a
+    # list of hashes in the same order
+    #
+    # Each record gets exactly the hash generate_hash would
+    # give it, but instead of one query per candidate, all the
+    # candidates in a round are checked with a single hash__in
+    # query (per chunk_size hashes). Only the ones that turn out
+    # to be taken, either in the database or by an earlier
+    # record in the same batch, move on to their next counter
+    # value and go around again, so almost every batch takes a
+    # single round.
+    #
+    # NOTE: like generate_hash, this can't see hashes that are
+    # being inserted by other transactions at the same time.
+    #
+    @classmethod
+    def generate_hashes(klass, cls, hashkey, args_list, chunk_size = 500):
+        prepared = [ klass.prepare_hash(hashkey, *args) for args in args_list ]
+        counters = [ 0 ] * len(args_list)
+        hashes = [ None ] * len(args_list)
+        accepted = set()
+        pending = range(len(args_list))
+        while len(pending) > 0:
+
+            # next usable candidate for each pending record
+            candidates = {}
+            for i in pending:
+                while True:
+                    counters[i] += 1
+                    encoded_hash = klass.finish_hash(prepared[i], counters[i])
+                    if encoded_hash[0] in '-_':
+                        # we don't want user hashes that start with these
+                        continue
+                    if encoded_hash in accepted or encoded_hash in candidates:
+                        # already claimed by another record in this batch
+                        continue
+                    candidates[encoded_hash] = i
+                    break
+
+            # one query to find which are already in use
+            in_use = set()
+            candidate_list = candidates.keys()
+            for i in xrange(0, len(candidate_list), chunk_size):
+                in_use.update(cls.objects.filter(hash__in = candidate_list[i:i + chunk_size]).values_list('hash', flat = True))
+
+            # keep the rest; the collisions go around again
+            pending = []
+            for encoded_hash, i in candidates.iteritems():
+                if encoded_hash in in_use:
+                    pending.append(i)
+                else:
+                    hashes[i] = encoded_hash
+                    accepted.add(encoded_hash)
+            pending.sort()
+
+        return hashes
+
     @classmethod
     def generate_hash_core(cls, counter, hashkey, *args):
-        raw_hash = hmac.new(hashkey, repr(args) + str(counter), hashlib.sha256).digest()
-        encoded_hash = base64.urlsafe_b64encode(raw_hash)[:43]  # strips always-present trailing =
+        return cls.finish_hash(cls.prepare_hash(hashkey, *args), counter)
+
+    # Hashing is split in two so that the expensive parts are
+    # done as few times as possible: prepare_hash encodes the
+    # arguments once per record, and finish_hash runs the HMAC
+    # over them and the counter, so trying several counter
+    # values for one record doesn't encode it again.
+    #
+    # The HMAC itself (RFC 2104, exactly what hmac.new computes)
+    # is done by hand from SHA-256 states that were keyed with
+    # the secret once and are only copied after that; building
+    # a new hmac object, or even copying one, costs more than
+    # hashing a short message.
+    @classmethod
+    def prepare_hash(cls, hashkey, *args):
+        keyed = _prepared_hmacs.get(hashkey)
+        if keyed is None:
+            keyed = cls._key_hmac(hashkey)
+            _prepared_hmacs[hashkey] = keyed
+        return (keyed, cls.encode_args(args))
+
+    @classmethod
+    def finish_hash(cls, prepared, counter):
+        (inner, outer), encoded_args = prepared
+        inner = inner.copy()
+        inner.update(encoded_args + str(counter))
+        outer = outer.copy()
+        outer.update(inner.digest())
+        encoded_hash = base64.urlsafe_b64encode(outer.digest())[:43]  # strips always-present trailing =
         return encoded_hash
-        
\ No newline at end of file
+
+    @classmethod
+    def _key_hmac(cls, hashkey):
+        block_size = hashlib.sha256().block_size
+        if len(hashkey) > block_size:
+            hashkey = hashlib.sha256(hashkey).digest()
+        hashkey = hashkey + chr(0) * (block_size - len(hashkey))
+        inner = hashlib.sha256(hashkey.translate(hmac.trans_36))
+        outer = hashlib.sha256(hashkey.translate(hmac.trans_5C))
+        return (inner, outer)
+
+    # encode the hash arguments as a byte string
+    #
+    # This used to be repr(args) for everything, which often
+    # doesn't identify the value at all (a model instance's
+    # repr is just its class and str(), which two records can
+    # share, or which can change when the record does).
+    # Plain values still go through repr, so their hashes are
+    # unchanged; anything else gets an encoding that depends
+    # only on the values: every value is tagged with its type,
+    # variable-length values carry their length, and records
+    # are reduced to their model and ID, so different arguments
+    # can't run together into the same bytes.
+    #
+    # NOTE: hashes generated from arguments that include
+    # records, aware datetimes or other objects are not the
+    # same as the ones repr would have produced. That only
+    # matters if you were regenerating a hash to compare it
+    # with a stored one; stored hashes stay valid.
+    #
+    @classmethod
+    def encode_args(cls, args):
+        args = tuple(args)
+
+        # For the usual AUTOHASH_FIELDS values (text, numbers,
+        # and the naive UTC timestamp AutoHashMixin adds) repr
+        # already depends only on the value, and it's much
+        # faster than anything we can write in Python, so use
+        # it whenever every argument is one of those. (It
+        # can't be confused with the tagged encoding below,
+        # which never starts with a parenthesis.)
+        for value in args:
+            value_type = type(value)
+            if value_type not in _repr_safe_types or (value_type is datetime.datetime and value.tzinfo is not None):
+                break
+        else:
+            return repr(args)
+
+        parts = [ 'l%d:' % len(args) ]
+        for value in args:
+            cls._encode_value(value, parts)
+        return ''.join(parts)
+
+    @classmethod
+    def _encode_value(cls, value, parts):
+
+        # the common types, by exact type, without a chain of
+        # isinstance checks
+        encoder = _simple_encoders.get(type(value))
+        if encoder is not None:
+            parts.append(encoder(value))
+        elif isinstance(value, (list, tuple)):
+            parts.append('l%d:' % len(value))
+            for item in value:
+                cls._encode_value(item, parts)
+        elif hasattr(value, '_meta') and hasattr(value, 'pk'):
+            # a model instance
+            opts = value._meta.concrete_model._meta
+            parts.append('m')
+            parts.append(_encode_unicode(u'%s.%s' % (opts.app_label, opts.model_name)))
+            cls._encode_value(value.pk, parts)
+        else:
+            # subclasses of the simple types, and anything else
+            # (UUIDs, times, files...), which goes by its type
+            # and text
+            for base_type, encoder in _subclass_encoders:
+                if isinstance(value, base_type):
+                    parts.append(encoder(value))
+                    return
+            parts.append('o')
+            parts.append(_encode_str(type(value).__name__))
+            parts.append(_encode_unicode(unicode(value)))
+
+
+def _encode_unicode(value):
+    value = value.encode('utf-8')
+    return 'u%d:%s' % (len(value), value)
+
+def _encode_str(value):
+    return 's%d:%s' % (len(value), value)
+
+def _encode_int(value):
+    return 'i%d;' % value
+
+_simple_encoders = {
+        type(None): lambda value: 'N',
+        bool: lambda value: 'T' if value else 'F',
+        unicode: _encode_unicode,
+        str: _encode_str,
+        int: _encode_int,
+        long: _encode_int,
+        float: lambda value: 'f%r;' % value,
+        decimal.Decimal: lambda value: 'd%s;' % value,
+        datetime.datetime: lambda value: 't%s;' % value.isoformat(),
+        datetime.date: lambda value: 'D%s;' % value.isoformat(),
+    }
+
+# types whose repr() is fully determined by their value
+_repr_safe_types = frozenset([ type(None), bool, unicode, str, int, long, float, decimal.Decimal, datetime.datetime, datetime.date ])
+
+# in order; datetime before date, as it's a subclass
+_subclass_encoders = [
+        (unicode, _encode_unicode),
+        (str, _encode_str),
+        (numbers.Integral, _encode_int),
+        (float, _simple_encoders[float]),
+        (decimal.Decimal, _simple_encoders[decimal.Decimal]),
+        (datetime.datetime, _simple_encoders[datetime.datetime]),
+        (datetime.date, _simple_encoders[datetime.date]),
+    ]
@@ -0,0 +1,119 @@
+import threading
+
+# IdentityMap
+#
+# Django hands back a brand new Python object every time a row
+# is loaded, so over the course of a request the same record
+# can end up in memory several times: once from the original
+# query, again from a fetch_related, again while walking a
+# tree. Besides the wasted effort, changes made to one copy
+# are not seen by the others.
+#
+# An identity map keeps one instance per (model, primary key)
+# while it's active. The helpers in this package that load
+# records in bulk (ModelTools.fetch_related and the
+# SimpleTreeMixin fetch methods) consult it: if an instance for
+# a row is already known, that instance is used in place of
+# the newly-loaded copy, and otherwise the new one is
+# remembered. Walking up a tree with get_parents will use a
+# known parent rather than querying for it at all.
+#
+# This is strictly opt-in. Use it as a context manager around
+# the code that should share instances:
+#
+#   with IdentityMap():
+#       ModelTools.fetch_related(orders, 'lines')
+#       ...
+#
+# or, to cover every request, add
+# 'sculpt.model_tools.identity_map.IdentityMapMiddleware' to
+# MIDDLEWARE_CLASSES.
+#
+# NOTE: the map does not stop the database from sending the
+# row again, only us from keeping a second copy; the saving
+# is in memory and in the work done on each record after it
+# is loaded. It also holds on to every record it has seen
+# until it is closed, so don't keep one open around a job
+# that streams through millions of rows.
+#
+# NOTE: records loaded with only() or defer() are never added
+# to the map, as a later caller expecting a full record would
+# trip over the missing fields one query at a time.
+#
+# NOTE: maps are per-thread and can be nested; only the
+# innermost is active.
+#
+class IdentityMap(object):
+
+    _local = threading.local()
+
+    def __init__(self):
+        self._instances = {}
+
+    def __enter__(self):
+        self._get_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = self._get_stack()
+        if self in stack:
+            # also discard any inner maps someone forgot to close
+            del stack[stack.index(self):]
+
+    @classmethod
+    def _get_stack(cls):
+        if not hasattr(cls._local, 'stack'):
+            cls._local.stack = []
+        return cls._local.stack
+
+    # the innermost active map for this thread, or None
+    @classmethod
+    def get_active(cls):
+        stack = cls._get_stack()
+        if len(stack) > 0:
+            return stack[-1]
+        return None
+
+    @classmethod
+    def _get_key(cls, model_class, pk):
+        return (model_class._meta.concrete_model, pk)
+
+    # the known instance for a record, or None
+    def get(self, model_class, pk):
+        return self._instances.get(self._get_key(model_class, pk))
+
+    # record an instance, returning the one to use: either the
+    # instance already known for the same row, or this one
+    def add(self, instance):
+        if instance.pk is None or instance._deferred:
+            return instance
+        return self._instances.setdefault(self._get_key(instance.__class__, instance.pk), instance)
+
+    # forget about a record (e.g. after deleting it)
+    def discard(self, instance):
+        self._instances.pop(self._get_key(instance.__class__, instance.pk), None)
+
+    def clear(self):
+        self._instances.clear()
+
+    def __len__(self):
+        return len(self._instances)
+
+
+# IdentityMapMiddleware
+#
+# Opens an IdentityMap for the duration of each request. The
+# map is kept on the request so that we close the same one we
+# opened, even if a view leaves another open.
+#
+class IdentityMapMiddleware(object):
+
+    def process_request(self, request):
+        request._identity_map = IdentityMap().__enter__()
+
+    def process_response(self, request, response):
+        identity_map = getattr(request, '_identity_map', None)
+        if identity_map is not None:
+            identity_map.__exit__(None, None, None)
+            request._identity_map = None
+        return response
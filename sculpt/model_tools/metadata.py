@@ -0,0 +1,87 @@
+from django.db.models.fields import FieldDoesNotExist
+
+# ModelMetadata
+#
+# A lot of our helpers need to know things about a model's
+# fields: which names are fields at all, what their columns
+# are called, which are foreign keys. Django keeps all of that
+# in _meta, but getting at it means walking the field list
+# each time, and in the bulk helpers that happens once per
+# record. This collects what we need once per model class and
+# keeps it.
+#
+# Use ModelMetadata.get(model_class) to fetch (or build) the
+# entry for a model. Deferred-field classes and proxies share
+# the entry of their concrete model.
+#
+# Entries built before the app registry is ready might see a
+# half-finished model, so the whole cache is rebuilt for every
+# installed model when our AppConfig becomes ready (you must
+# have sculpt.model_tools in INSTALLED_APPS for that; see
+# OverridableChoicesConfig).
+#
+class ModelMetadata(object):
+
+    _cache = {}
+
+    def __init__(self, model_class):
+        opts = model_class._meta
+        self.model = model_class
+
+        # all fields, and the names (as unicode, for matching
+        # incoming data) of each
+        self.fields = list(opts.fields)
+        self.field_names = frozenset([ unicode(f.name) for f in self.fields ])
+        self.field_name_list = [ f.name for f in self.fields ]
+
+        # fields that have a column, split into foreign keys
+        # and everything else
+        self.concrete_fields = list(opts.concrete_fields)
+        self.foreign_key_fields = [ f for f in self.concrete_fields if f.rel is not None ]
+        self.local_value_fields = [ f for f in self.concrete_fields if f.rel is None ]
+        self.attnames = frozenset([ f.attname for f in self.concrete_fields ])
+        self.columns = dict([ (f.name, f.column) for f in self.concrete_fields ])
+
+        # any concrete field by name or attname (e.g. 'parent'
+        # or 'parent_id'), plus 'pk'
+        self.fields_by_name = {}
+        for f in self.concrete_fields:
+            self.fields_by_name[f.name] = f
+            self.fields_by_name[f.attname] = f
+        self.fields_by_name['pk'] = opts.pk
+
+        # the bit for each concrete field in a dirty mask (see
+        # ModelTools.set_and_track_dirty), by name and attname,
+        # and the field names in bit order
+        self.dirty_bits = {}
+        self.dirty_field_names = []
+        for i, f in enumerate(self.concrete_fields):
+            self.dirty_bits[f.name] = 1 << i
+            self.dirty_bits[f.attname] = 1 << i
+            self.dirty_field_names.append(f.name)
+
+    @classmethod
+    def get(cls, model_class):
+        model_class = model_class._meta.concrete_model
+        metadata = cls._cache.get(model_class)
+        if metadata is None:
+            metadata = cls(model_class)
+            cls._cache[model_class] = metadata
+        return metadata
+
+    # throw away anything built so far and build entries for
+    # every installed model
+    @classmethod
+    def prepare_all(cls):
+        from django.apps import apps
+        cls._cache = {}
+        for model_class in apps.get_models():
+            cls.get(model_class)
+
+    # a concrete field by name or attname; anything else is an
+    # error
+    def get_field(self, name):
+        field = self.fields_by_name.get(name)
+        if field is None:
+            raise FieldDoesNotExist('%s has no field named %r (lookups with __ are not supported here)' % (self.model._meta.object_name, name))
+        return field
@@ -1,8 +1,12 @@
 from django.apps import AppConfig
 from django.contrib.auth.hashers import check_password, make_password, is_password_usable
-from django.db import models
+from django.db import IntegrityError, connection, models, router, transaction
 from sculpt.common import Enumeration
+from sculpt.model_tools.backends import supports_recursive_cte
 from sculpt.model_tools.hash_generator import ModelHashGenerator
+from sculpt.model_tools.identity_map import IdentityMap
+from sculpt.model_tools.metadata import ModelMetadata
+from sculpt.model_tools.tree import TreeCache, TreeSnapshot
 import datetime
 
 # Useful things to include in Model definitions
@@ -63,7 +67,7 @@ class SimpleUnicodeMixin(object):
 #      this means there is a race condition where two
 #      concurrent inserts of identical data may clash
 #      and cause one to fail, even with the additional
-#      checks.
+#      checks. (AUTOHASH_OPTIMISTIC, below, avoids this.)
 #
 #   3. Since hash generation data comes from outside
 #      the field itself, this is a MODEL mix-in and not
@@ -89,6 +93,23 @@ class SimpleUnicodeMixin(object):
 #       otherwise, they will only be generated when
 #       generate_hash is specifically called (default: False)
 #
+#   AUTOHASH_OPTIMISTIC - if set to True, save() does not
+#       check the database before using a hash; it just
+#       inserts, and if the unique index on the hash
+#       rejects it, tries again with the next hash (inside
+#       a savepoint, so the surrounding transaction is
+#       unharmed). This saves a query on every insert and
+#       also closes the race in (2) above, but needs the
+#       unique index (AbstractAutoHash has one) (default:
+#       False)
+#
+#   AUTOHASH_MAX_ATTEMPTS - with AUTOHASH_OPTIMISTIC, how
+#       many hashes to try before giving up and letting the
+#       IntegrityError through (default: 5); any
+#       IntegrityError is retried, so a record that breaks
+#       some other constraint takes this many attempts to
+#       fail
+#
 class AutoHashMixin(object):
     
     # a convenient wrapper around the base ModelHashGenerator,
@@ -97,18 +118,50 @@ class AutoHashMixin(object):
     def generate_hash(self):
     
         # collect all the arguments together
+        args = self._get_hash_args()
+
+        # AUTOHASH_SECRET is required
+        self._check_hash_secret()
+
+        # generate the hash and record it            
+        self.hash = ModelHashGenerator.generate_hash(self.__class__, self.AUTOHASH_SECRET, *args)
+
+    # generate_hash for a list of (unsaved) records, checking
+    # the candidates with one query per batch instead of one
+    # per record; records that already have a hash are left
+    # alone
+    #
+    # save() fills in a hash automatically but bulk_create
+    # doesn't call save(), so call this first:
+    #
+    #   Voucher.generate_hashes(vouchers)
+    #   Voucher.objects.bulk_create(vouchers)
+    #
+    # (ModelTools.bulk_create_with_extra does this for you.)
+    #
+    @classmethod
+    def generate_hashes(cls, records):
+        records = [ r for r in records if r.hash == None or r.hash == '' ]
+        if len(records) == 0:
+            return
+        cls._check_hash_secret()
+        hashes = ModelHashGenerator.generate_hashes(cls, cls.AUTOHASH_SECRET, [ r._get_hash_args() for r in records ])
+        for record, encoded_hash in zip(records, hashes):
+            record.hash = encoded_hash
+
+    def _get_hash_args(self):
         args = [ getattr(self, field) for field in self.AUTOHASH_FIELDS ]
 
         # include current timestamp unless we're directed not to
         if not getattr(self, 'AUTOHASH_NO_DATETIME', False):
             args.append(datetime.datetime.utcnow())
 
-        # AUTOHASH_SECRET is required
-        if self.AUTOHASH_SECRET is None:
-            raise Exception('AUTOHASH_SECRET must be defined in your derived class. Refusing to operate without a defined secret.')
+        return args
 
-        # generate the hash and record it            
-        self.hash = ModelHashGenerator.generate_hash(self.__class__, self.AUTOHASH_SECRET, *args)
+    @classmethod
+    def _check_hash_secret(cls):
+        if cls.AUTOHASH_SECRET is None:
+            raise Exception('AUTOHASH_SECRET must be defined in your derived class. Refusing to operate without a defined secret.')
         
     # override the model save method
     def save(self, *args, **kwargs):
@@ -116,15 +169,135 @@ class AutoHashMixin(object):
         # if we're not allowing empty hashes, and this object
         # has an empty hash, fill it in right now
         if not getattr(self, 'AUTOHASH_ALLOW_EMPTY', False) and (self.hash == None or self.hash == ''):
+            if getattr(self, 'AUTOHASH_OPTIMISTIC', False):
+                return self._save_optimistic(*args, **kwargs)
             self.generate_hash()
             
         # pass through to the regular save method
-        return super(AutoHashMixin, self).save(**kwargs)
+        return super(AutoHashMixin, self).save(*args, **kwargs)
+
+    # save with each candidate hash in turn until the database
+    # accepts one
+    def _save_optimistic(self, *args, **kwargs):
+        self._check_hash_secret()
+        max_attempts = getattr(self, 'AUTOHASH_MAX_ATTEMPTS', 5)
+        # the savepoint has to be on the database we're saving to
+        # (using is the third positional argument to save)
+        using = kwargs.get('using') or (args[2] if len(args) > 2 else None) or router.db_for_write(self.__class__, instance = self)
+        original_hash = self.hash
+        attempts = 0
+        for encoded_hash in ModelHashGenerator.candidate_hashes(self.AUTOHASH_SECRET, *self._get_hash_args()):
+            attempts += 1
+            self.hash = encoded_hash
+            try:
+                with transaction.atomic(using = using):
+                    return super(AutoHashMixin, self).save(*args, **kwargs)
+            except IntegrityError:
+                # we can't tell which constraint was hit, and
+                # reading the hash back won't see a concurrent
+                # insert under REPEATABLE READ (see
+                # set_isolation_mode), so retry any clash
+                if attempts >= max_attempts:
+                    self.hash = original_hash
+                    raise
 
 
 # a URL pattern fragment to match hashes
 AUTOHASH_URL_PATTERN = r'[-_0-9A-Za-z]{43}'
- 
+
+# SnapshotDirtyMixin
+#
+# ModelTools.set_and_track_dirty only knows about changes made
+# through it; anything assigned directly to a field is missed,
+# so the safe thing to do is a full save(), which rewrites
+# every column. This mixin notices changes however they are
+# made.
+#
+# When a record is created (including when Django loads it
+# from the database) we keep a copy of its field values. At
+# save time we compare against that copy, and:
+#
+#   1. If nothing has changed, save() does nothing at all.
+#   2. Otherwise, save() passes update_fields listing only
+#      the changed fields (plus any auto_now fields, which
+#      expect to be touched on every save).
+#
+# New records, and any save() that is told explicitly what to
+# do (update_fields, force_insert, or positional arguments),
+# are passed straight through. After every save the copy is
+# brought up to date.
+#
+# Add it ahead of models.Model in your base classes:
+#
+#   class Widget(SnapshotDirtyMixin, models.Model):
+#       ...
+#
+# You can also ask a record what has changed with
+# get_changed_fields() or has_changes().
+#
+# NOTE: the copy is shallow. If a field holds a mutable value
+# (e.g. a dict in a JSON field) and you change it in place,
+# the change is not noticed; assign a new value instead.
+#
+# NOTE: a deferred field (see only() and defer()) has no
+# original value to compare with, so once it has been loaded
+# or assigned it always counts as changed.
+#
+class SnapshotDirtyMixin(object):
+
+    def __init__(self, *args, **kwargs):
+        super(SnapshotDirtyMixin, self).__init__(*args, **kwargs)
+        self._take_snapshot()
+
+    # record the current value of each loaded field (or just
+    # the named fields, after a partial save)
+    def _take_snapshot(self, field_names = None):
+        values = self.__dict__
+        if field_names is None:
+            self._snapshot = {}
+            fields = self._meta.concrete_fields
+        else:
+            field_names = set(field_names)
+            fields = [ f for f in self._meta.concrete_fields if f.name in field_names or f.attname in field_names ]
+        for f in fields:
+            if f.attname in values:
+                self._snapshot[f.attname] = values[f.attname]
+
+    # the names of the fields that differ from the snapshot
+    def get_changed_fields(self):
+        values = self.__dict__
+        snapshot = self._snapshot
+        changed = []
+        for f in self._meta.concrete_fields:
+            if f.primary_key or f.attname not in values:
+                # the primary key identifies the record; fields
+                # not in __dict__ are deferred and untouched
+                continue
+            if f.attname not in snapshot or snapshot[f.attname] != values[f.attname]:
+                changed.append(f.name)
+        return changed
+
+    def has_changes(self):
+        return len(self.get_changed_fields()) > 0
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if not self._state.adding and len(args) == 0 and update_fields is None and not kwargs.get('force_insert', False):
+            changed = self.get_changed_fields()
+            if len(changed) == 0:
+                # nothing to write
+                return
+            changed.extend([ f.name for f in self._meta.concrete_fields if getattr(f, 'auto_now', False) and f.name not in changed ])
+            kwargs['update_fields'] = changed
+            update_fields = changed
+
+        super(SnapshotDirtyMixin, self).save(*args, **kwargs)
+
+        if len(args) == 0:
+            self._take_snapshot(update_fields)
+        else:
+            self._take_snapshot()
+
 # LoginMixin
 #
 # Logging in doesn't have anything to do with authentication
@@ -383,6 +556,10 @@ class OverridableChoicesConfig(AppConfig):
         for cls, args in field_choices.iteritems():
             cls._set_field_choices(*args)
 
+        # now that every model is finished, build the field
+        # metadata used by ModelTools
+        ModelMetadata.prepare_all()
+
 # SimpleTreeMixin
 #
 # There are many ways to implement tree structures in SQL and various
@@ -413,8 +590,55 @@ class OverridableChoicesConfig(AppConfig):
 #   parent = models.ForeignKey('self', related_name = 'children', blank = True, null = True)
 #   display_order = models.IntegerField(default = 0)
 #
+# Siblings are almost always fetched by parent in display order
+# (get_previous, get_next, move_to, reorder_children, and any
+# children fetch), so give them an index to match:
+#
+#   class Meta:
+#       index_together = [ ('parent', 'display_order') ]
+#
+# The mixin's save() and delete() keep the materialized path
+# (see below) and TreeCache up to date, so add it ahead of
+# models.Model in your base classes, or they will never run:
+#
+#   class Category(SimpleTreeMixin, models.Model):
+#       ...
+#
+# If you mostly look up the tree (breadcrumbs, "is this inside
+# that" permission checks) you can also keep a materialized
+# path: each node stores the IDs of all its ancestors, root
+# first, e.g. '/1/5/9/' for a node whose parent is 9 (a root
+# node has '/'). Add a field for it and name it:
+#
+#   TREE_PATH_FIELD = 'tree_path'
+#   tree_path = models.CharField(max_length = 255, blank = True, default = '', db_index = True)
+#
+# With a path, get_parents and get_root take one query no
+# matter how deep the node is, and is_child_of takes none.
+# The path is kept up to date by save(); moving a node to a
+# new parent also rewrites the paths of all its descendants,
+# with a single UPDATE. That makes a move cost one query per
+# move rather than one per sibling, so the cheap-update
+# property above mostly survives, but it is no longer free.
+# Use rebuild_tree_paths() to fill in the paths for existing
+# rows.
+#
+# NOTE: the path is only maintained through save(); a
+# QuerySet.update() of parent will leave it wrong. The path
+# also assumes integer primary keys, and max_length limits
+# how deep the tree can go.
+#
+# Without a path, on databases that support WITH RECURSIVE
+# (PostgreSQL, SQLite 3.8.3+, MySQL 8, MariaDB 10.2+) the
+# walks are handed to the database instead: fetch_children
+# gets all the generations asked for in one query, and
+# get_parents gets the whole ancestor chain in one query.
+# Elsewhere they fall back to one query per generation.
+#
 class SimpleTreeMixin(object):
 
+    TREE_PATH_FIELD = None
+
     # get all ancestors, starting with the closest; if
     # oldest_first is True, returns the farthest ancestor
     # first instead (and it will return an iterator
@@ -424,13 +648,36 @@ class SimpleTreeMixin(object):
     # you locate the parents and then fetch the children
     # you will not get the same Python object that you
     # started with; you will get a copy of the same data
-    # from the database in a new Python object.
+    # from the database in a new Python object. (Unless an
+    # IdentityMap is active, in which case both will use the
+    # same objects, and parents already in the map are not
+    # fetched again.)
     #
     def get_parents(self, oldest_first = False, stop_at_id = None):
+        path_ids = self._get_path_ids()
+        if path_ids is not None:
+            return self._get_parents_by_path(path_ids, oldest_first, stop_at_id)
+
+        identity_map = IdentityMap.get_active()
+        use_cte = supports_recursive_cte(connection)
+        parent_cache_name = self._meta.get_field('parent').get_cache_name()
         ancestors = []
         node = self
-        while node.parent is not None and (stop_at_id is None or stop_at_id != node.pk):
-            node = node.parent
+        while node.parent_id is not None and (stop_at_id is None or stop_at_id != node.pk):
+            parent = None
+            if identity_map is not None:
+                parent = identity_map.get(node.__class__, node.parent_id)
+            if parent is None and use_cte and not hasattr(node, parent_cache_name):
+                # fetch (and link up) the rest of the chain at
+                # once; the walk carries on through the links
+                self._fetch_parents_cte(node, stop_at_id, identity_map)
+                use_cte = False
+            if parent is None:
+                parent = node.parent
+                if identity_map is not None:
+                    parent = identity_map.add(parent)
+            node.parent = parent
+            node = parent
             ancestors.append(node)
 
         if oldest_first:
@@ -447,6 +694,9 @@ class SimpleTreeMixin(object):
         # an empty list) if self is the candidate
         if self.pk == candidate_id:
             return allow_self
+        path_ids = self._get_path_ids()
+        if path_ids is not None:
+            return candidate_id in path_ids
         ancestors = self.get_parents(stop_at_id = candidate_id)
         return len(ancestors) > 0 and ancestors[-1].pk == candidate_id
 
@@ -458,8 +708,215 @@ class SimpleTreeMixin(object):
     def get_root(self):
         if self.parent_id is None:
             return self
+        path_ids = self._get_path_ids()
+        if path_ids is not None:
+            ancestors = self._get_linked_parents()
+            if len(ancestors) > 0 and ancestors[-1].parent_id is None:
+                return ancestors[-1]
+            return self._get_nodes_by_id(path_ids[:1])[path_ids[0]]
+        else:
+            return list(self.get_parents(oldest_first = True))[0]
+
+    # the ancestor IDs from the materialized path, root first,
+    # or None if there's no usable path (so walk instead)
+    def _get_path_ids(self):
+        path_field = self.TREE_PATH_FIELD
+        if path_field is None or self.parent_id is None:
+            return None
+        path = getattr(self, path_field)
+        if not path or path == '/':
+            # not filled in yet
+            return None
+        to_python = self._meta.pk.to_python
+        return [ to_python(pk) for pk in path.strip('/').split('/') ]
+
+    # the ancestors already linked up in memory (by an earlier
+    # walk, fetch_parents or a loaded tree), closest first
+    def _get_linked_parents(self):
+        parent_cache_name = self._meta.get_field('parent').get_cache_name()
+        ancestors = []
+        node = self
+        while node.parent_id is not None and hasattr(node, parent_cache_name):
+            parent = getattr(node, parent_cache_name)
+            if parent is None or parent.pk != node.parent_id:
+                break
+            ancestors.append(parent)
+            node = parent
+        return ancestors
+
+    # nodes by ID, from the identity map if there is one and
+    # from the database (in one query) otherwise
+    def _get_nodes_by_id(self, pks):
+        identity_map = IdentityMap.get_active()
+        found = {}
+        if identity_map is not None:
+            for pk in pks:
+                node = identity_map.get(self.__class__, pk)
+                if node is not None:
+                    found[pk] = node
+        missing = [ pk for pk in pks if pk not in found ]
+        if len(missing) > 0:
+            for node in self.__class__.objects.filter(pk__in = missing):
+                if identity_map is not None:
+                    node = identity_map.add(node)
+                found[node.pk] = node
+        return found
+
+    # get_parents using the path: follow the parents already
+    # linked in memory, then fetch the rest of the IDs in the
+    # path in one query and link those up as the walk in
+    # get_parents would (links already set are left alone)
+    def _get_parents_by_path(self, path_ids, oldest_first, stop_at_id):
+        if stop_at_id is not None and stop_at_id == self.pk:
+            return []
+        path_ids = list(reversed(path_ids))     # closest first
+        if stop_at_id is not None and stop_at_id in path_ids:
+            path_ids = path_ids[:path_ids.index(stop_at_id) + 1]
+
+        ancestors = self._get_linked_parents()[:len(path_ids)]
+        missing = path_ids[len(ancestors):]
+        if len(missing) > 0:
+            parent_cache_name = self._meta.get_field('parent').get_cache_name()
+            found = self._get_nodes_by_id(missing)
+            node = ancestors[-1] if len(ancestors) > 0 else self
+            for pk in missing:
+                parent = found.get(pk)
+                if parent is None:
+                    continue
+                if parent.pk == node.parent_id and not hasattr(node, parent_cache_name):
+                    node.parent = parent
+                ancestors.append(parent)
+                node = parent
+
+        if oldest_first:
+            return reversed(ancestors)
+        else:
+            return ancestors
+
+    # load every ancestor of a node (up to and including
+    # stop_at_id) in one recursive query, and set each one's
+    # parent to the next
+    def _fetch_parents_cte(self, node, stop_at_id, identity_map):
+        qn = connection.ops.quote_name
+        opts = self._meta
+        table = qn(opts.db_table)
+        pk_column = qn(opts.pk.column)
+        parent_column = qn(opts.get_field('parent').column)
+
+        # UNION rather than UNION ALL, so a cycle in the data
+        # can't run forever
+        cte = (
+                'WITH RECURSIVE tree_parents (id, parent_id) AS ('
+                    'SELECT %(pk)s, %(parent)s FROM %(table)s WHERE %(pk)s = %%s '
+                    'UNION '
+                    'SELECT tree_parent.%(pk)s, tree_parent.%(parent)s FROM %(table)s tree_parent '
+                    'INNER JOIN tree_parents ON tree_parent.%(pk)s = tree_parents.parent_id'
+                    '%(stop)s'
+                ') SELECT id FROM tree_parents'
+            ) % {
+                'table': table,
+                'pk': pk_column,
+                'parent': parent_column,
+                'stop': ' WHERE tree_parents.id <> %s' if stop_at_id is not None else '',
+            }
+        params = [ node.parent_id ]
+        if stop_at_id is not None:
+            params.append(stop_at_id)
+
+        fetched = {}
+        for parent in node.__class__.objects.extra(where = [ '%s.%s IN (%s)' % (table, pk_column, cte) ], params = params):
+            if identity_map is not None:
+                parent = identity_map.add(parent)
+            fetched[parent.pk] = parent
+
+        while node.parent_id in fetched and (stop_at_id is None or stop_at_id != node.pk):
+            node.parent = fetched.pop(node.parent_id)
+            node = node.parent
+
+    # keep the materialized path (if any) up to date, and let
+    # TreeCache know the tree has changed
+    def save(self, *args, **kwargs):
+        path_field = self.TREE_PATH_FIELD
+        update_fields = kwargs.get('update_fields')
+        if path_field is None or (update_fields is not None and 'parent' not in update_fields and 'parent_id' not in update_fields):
+            result = super(SimpleTreeMixin, self).save(*args, **kwargs)
+            TreeCache.invalidate(self.__class__)
+            return result
+
+        old_path = getattr(self, path_field)
+        path_ids = self._get_path_ids()
+        if self.parent_id is None:
+            new_path = '/'
+        elif path_ids is not None and path_ids[-1] == self._meta.pk.to_python(self.parent_id):
+            # same parent, so the path we have is still right
+            new_path = old_path
         else:
-            return self.get_parents(oldest_first = True)[0]
+            # the parent has changed (or the path was never
+            # filled in); take the parent's path from the
+            # database rather than trusting a loaded parent
+            parent_path = self.__class__.objects.filter(pk = self.parent_id).values_list(path_field, flat = True).first()
+            new_path = (parent_path or '/') + '%s/' % self.parent_id
+            if self.pk is not None and '/%s/' % self.pk in new_path:
+                raise ValueError('%s %s cannot be moved inside its own subtree' % (self.__class__.__name__, self.pk))
+
+        setattr(self, path_field, new_path)
+        if update_fields is not None:
+            kwargs['update_fields'] = list(update_fields) + [ path_field ]
+
+        with transaction.atomic():
+            result = super(SimpleTreeMixin, self).save(*args, **kwargs)
+            if old_path and old_path != new_path and not kwargs.get('force_insert'):
+                self._move_descendant_paths(old_path + '%s/' % self.pk, new_path + '%s/' % self.pk)
+        TreeCache.invalidate(self.__class__)
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(SimpleTreeMixin, self).delete(*args, **kwargs)
+        TreeCache.invalidate(self.__class__)
+        return result
+
+    # swap the start of the path of everything under this node,
+    # in one UPDATE
+    def _move_descendant_paths(self, old_prefix, new_prefix):
+        qn = connection.ops.quote_name
+        column = qn(self._meta.get_field(self.TREE_PATH_FIELD).column)
+        if connection.vendor == 'mysql':
+            new_value = 'CONCAT(%%s, SUBSTR(%s, %%s))' % column
+        else:
+            new_value = '%%s || SUBSTR(%s, %%s)' % column
+        cursor = connection.cursor()
+        cursor.execute(
+                'UPDATE %s SET %s = %s WHERE %s LIKE %%s' % (qn(self._meta.db_table), column, new_value, column),
+                [ new_prefix, len(old_prefix) + 1, old_prefix + '%' ],
+            )
+
+    # fill in (or repair) the materialized path of every node;
+    # reads just the IDs and parent IDs of the whole tree, then
+    # writes the paths back with ModelTools.bulk_update
+    @classmethod
+    def rebuild_tree_paths(cls, chunk_size = 500):
+        from sculpt.model_tools.tools import ModelTools
+
+        path_field = cls.TREE_PATH_FIELD
+        if path_field is None:
+            raise Exception('TREE_PATH_FIELD must be defined in your derived class to use rebuild_tree_paths.')
+
+        children = {}
+        for pk, parent_id in cls.objects.values_list('pk', 'parent_id'):
+            children.setdefault(parent_id, []).append(pk)
+
+        # work down from the roots, so each parent's path is
+        # known before its children's
+        records = []
+        queue = [ (pk, '/') for pk in children.get(None, []) ]
+        while len(queue) > 0:
+            pk, path = queue.pop()
+            records.append(cls(pk = pk, **{ path_field: path }))
+            for child_pk in children.get(pk, []):
+                queue.append((child_pk, path + '%s/' % pk))
+
+        ModelTools.bulk_update(records, [ path_field ], chunk_size = chunk_size)
+        TreeCache.invalidate(cls)
 
     # get all siblings
     #
@@ -474,15 +931,105 @@ class SimpleTreeMixin(object):
     # you need more than one, it's likely more efficient
     # to use get_siblings() and work through the list.
     #
+    # Siblings with the same display_order are taken in ID
+    # order, as move_to and reorder_children do.
+    #
     def get_previous(self):
         return self.__class__.objects.filter(
-                display_order_lt = self.display_order,
-            ).order_by('-display_order').first()
+                models.Q(display_order__lt = self.display_order) | models.Q(display_order = self.display_order, pk__lt = self.pk),
+                parent_id = self.parent_id,
+            ).order_by('-display_order', '-pk').first()
         
     def get_next(self):
         return self.__class__.objects.filter(
-                display_order_gt = self.display_order,
-            ).order_by('display_order').first()
+                models.Q(display_order__gt = self.display_order) | models.Q(display_order = self.display_order, pk__gt = self.pk),
+                parent_id = self.parent_id,
+            ).order_by('display_order', 'pk').first()
+
+    # move this node to be a child of parent (a node, its ID,
+    # or None for the top level), at position amongst its new
+    # siblings (0 is first; None, the default, is last;
+    # negative numbers count from the end, as with
+    # list.insert)
+    #
+    # The new siblings are renumbered 0, 1, 2... in their
+    # current order with this node inserted, but only the ones
+    # whose display_order actually changes are written, with a
+    # single UPDATE (see ModelTools.bulk_update). If the parent
+    # changes, the node itself is saved as well, which keeps
+    # any materialized path up to date. The siblings left
+    # behind keep their numbers; a gap does no harm.
+    #
+    def move_to(self, parent, position = None):
+        if parent is not None and not hasattr(parent, 'pk'):
+            parent = self.__class__.objects.get(pk = parent)
+        parent_id = parent.pk if parent is not None else None
+        if parent is not None and parent.is_child_of(self.pk):
+            raise ValueError('%s %s cannot be moved inside its own subtree' % (self.__class__.__name__, self.pk))
+
+        sibling_ids = list(self.__class__.objects.filter(
+                parent_id = parent_id,
+            ).exclude(
+                pk = self.pk,
+            ).order_by('display_order', 'pk').values_list('pk', 'display_order'))
+        if position is None:
+            sibling_ids.append((self.pk, None))
+        else:
+            sibling_ids.insert(position, (self.pk, None))
+
+        position = [ pk for pk, display_order in sibling_ids ].index(self.pk)
+        with transaction.atomic():
+            if parent_id != self.parent_id:
+                self.parent = parent
+                self.display_order = position
+                self.save()
+                sibling_ids[position] = (self.pk, position)
+            else:
+                self.display_order = position
+            self._renumber_siblings(sibling_ids)
+        TreeCache.invalidate(self.__class__)
+
+    # put the children of parent (a node, its ID, or None for
+    # the top level) in the order given by ordered_pks; any
+    # children not listed keep their order, after the listed
+    # ones
+    #
+    # As with move_to, the changed display_order values are
+    # written with a single UPDATE.
+    #
+    @classmethod
+    def reorder_children(cls, parent, ordered_pks):
+        # IDs may come straight from a form or URL, as strings
+        to_python = cls._meta.pk.to_python
+        parent_id = to_python(getattr(parent, 'pk', parent))
+        ordered_pks = [ to_python(pk) for pk in ordered_pks ]
+        sibling_ids = list(cls.objects.filter(
+                parent_id = parent_id,
+            ).order_by('display_order', 'pk').values_list('pk', 'display_order'))
+
+        current = dict(sibling_ids)
+        listed = set()
+        for pk in ordered_pks:
+            if pk not in current:
+                raise ValueError('%s %s is not a child of %s' % (cls.__name__, pk, parent_id))
+            if pk in listed:
+                raise ValueError('%s %s is listed more than once' % (cls.__name__, pk))
+            listed.add(pk)
+        sibling_ids = [ (pk, current[pk]) for pk in ordered_pks ] + [ (pk, display_order) for pk, display_order in sibling_ids if pk not in listed ]
+
+        with transaction.atomic():
+            cls._renumber_siblings(sibling_ids)
+        TreeCache.invalidate(cls)
+
+    # given (ID, current display_order) pairs in the order
+    # wanted, write display_order = position for the ones that
+    # are out of place, in one UPDATE
+    @classmethod
+    def _renumber_siblings(cls, sibling_ids):
+        from sculpt.model_tools.tools import ModelTools
+
+        records = [ cls(pk = pk, display_order = i) for i, (pk, display_order) in enumerate(sibling_ids) if display_order != i ]
+        ModelTools.bulk_update(records, [ 'display_order' ])
         
     # get children
     # 
@@ -521,7 +1068,20 @@ class SimpleTreeMixin(object):
 
         else:
             all_nodes = dict([ (r.pk,r) for r in nodes ])
+
+        # let anything else loaded this request see our nodes
+        # (fetch_related takes care of the ones we fetch)
+        identity_map = IdentityMap.get_active()
+        if identity_map is not None:
+            for n in nodes:
+                identity_map.add(n)
         
+        # let the database do the walking if it can, and we
+        # have more than one generation to fetch
+        if generations != 0 and generations != 1 and len(nodes) > 0 and supports_recursive_cte(connection):
+            cls._fetch_children_cte(nodes, all_nodes, generations, q, order_by, select_related, identity_map)
+            return all_nodes
+
         # we test for equivalence to zero so that
         # -1 can be passed for "all" (dangerous;
         # if you know you need ALL nodes, not just
@@ -564,6 +1124,187 @@ class SimpleTreeMixin(object):
             
         return all_nodes
 
+    # fetch_children, with all the generations fetched by one
+    # recursive query (per 500 starting nodes) and then sorted
+    # out generation by generation exactly as the loop in
+    # fetch_children would
+    #
+    # The query finds every descendant, whether or not it
+    # matches q; q is applied to the results. A node that
+    # doesn't match q still cuts off everything below it,
+    # because nothing is attached unless its parent was.
+    #
+    @classmethod
+    def _fetch_children_cte(cls, nodes, all_nodes, generations, q, order_by, select_related, identity_map):
+        from sculpt.model_tools.tools import ModelTools
+
+        node_class = nodes[0].__class__
+        qn = connection.ops.quote_name
+        opts = node_class._meta
+        table = qn(opts.db_table)
+        pk_column = qn(opts.pk.column)
+        parent_column = qn(opts.get_field('parent').column)
+
+        # with a generation limit we count depth (and UNION
+        # ALL is safe, as the limit stops any cycle); without,
+        # UNION discards repeats, which stops cycles instead
+        if generations > 0:
+            cte = (
+                    'WITH RECURSIVE tree_nodes (id, depth) AS ('
+                        'SELECT %(pk)s, 1 FROM %(table)s WHERE %(parent)s IN (%(ids)s) '
+                        'UNION ALL '
+                        'SELECT tree_child.%(pk)s, tree_nodes.depth + 1 FROM %(table)s tree_child '
+                        'INNER JOIN tree_nodes ON tree_child.%(parent)s = tree_nodes.id '
+                        'WHERE tree_nodes.depth < %%s'
+                    ') SELECT id FROM tree_nodes'
+                )
+        else:
+            cte = (
+                    'WITH RECURSIVE tree_nodes (id) AS ('
+                        'SELECT %(pk)s FROM %(table)s WHERE %(parent)s IN (%(ids)s) '
+                        'UNION '
+                        'SELECT tree_child.%(pk)s FROM %(table)s tree_child '
+                        'INNER JOIN tree_nodes ON tree_child.%(parent)s = tree_nodes.id'
+                    ') SELECT id FROM tree_nodes'
+                )
+
+        if isinstance(order_by, basestring):
+            order_by = [ order_by ]
+        if isinstance(select_related, basestring):
+            select_related = [ select_related ]
+
+        # everything fetched, in order, by parent; a node whose
+        # ancestors were split across chunks comes back once per
+        # chunk, so keep only the first copy
+        fetched_children = {}
+        fetched_pks = set()
+        for chunk in ModelTools._split_list([ n.pk for n in nodes ], 500):
+            params = list(chunk)
+            if generations > 0:
+                params.append(generations)
+            sql = cte % {
+                    'table': table,
+                    'pk': pk_column,
+                    'parent': parent_column,
+                    'ids': ', '.join([ '%s' ] * len(chunk)),
+                }
+            children = node_class.objects.extra(where = [ '%s.%s IN (%s)' % (table, pk_column, sql) ], params = params)
+            if q is not None:
+                children = children.filter(q)
+            children = children.order_by(*order_by)
+            if select_related is not None:
+                children = children.select_related(*select_related)
+            for child in children:
+                if child.pk not in fetched_pks:
+                    fetched_pks.add(child.pk)
+                    fetched_children.setdefault(child.parent_id, []).append(child)
+
+        # now attach them a generation at a time, starting from
+        # the nodes we were given
+        while generations != 0 and len(nodes) > 0:
+            generations -= 1
+            new_nodes = []
+            for n in nodes:
+                n.children_list = []
+                for nn in fetched_children.get(n.pk, []):
+                    # reuse a node we already had, if any
+                    if nn.pk in all_nodes:
+                        nn = all_nodes[nn.pk]
+                    else:
+                        if identity_map is not None:
+                            nn = identity_map.add(nn)
+                        all_nodes[nn.pk] = nn
+                    nn.parent = n
+                    n.children_list.append(nn)
+
+                    # as in fetch_children, only nodes that have
+                    # not been expanded yet go on to the next
+                    # generation
+                    if not hasattr(nn, 'children_list'):
+                        new_nodes.append(nn)
+            nodes = new_nodes
+
+    # get_parents for a whole list of nodes at once (e.g.
+    # breadcrumbs for a page of search results); the ancestors
+    # of each node are stored in .parents_list on that node,
+    # closest first, and each node's parent is linked up as
+    # get_parents would
+    #
+    # Ancestors are fetched a generation at a time, one query
+    # per generation for all the nodes together, so the cost
+    # depends on the depth of the tree and not on the number
+    # of nodes; an ancestor shared by many nodes (the root,
+    # usually) is fetched once and shared. With a materialized
+    # path, every ancestor is fetched in a single query.
+    #
+    # Returns a dictionary of the nodes and all their
+    # ancestors, by ID.
+    #
+    @classmethod
+    def fetch_parents(cls, nodes):
+        from sculpt.model_tools.tools import ModelTools
+
+        nodes = list(nodes)
+        if len(nodes) == 0:
+            return {}
+        node_class = nodes[0].__class__
+
+        # (the nodes we were given are the ones that get the
+        # parents_list, even if the identity map knows others)
+        identity_map = IdentityMap.get_active()
+        if identity_map is not None:
+            for n in nodes:
+                identity_map.add(n)
+        all_nodes = dict([ (n.pk, n) for n in nodes ])
+
+        def fetch(ids):
+            ids = [ pk for pk in ids if pk not in all_nodes ]
+            if identity_map is not None:
+                for pk in ids:
+                    n = identity_map.get(node_class, pk)
+                    if n is not None:
+                        all_nodes[pk] = n
+                ids = [ pk for pk in ids if pk not in all_nodes ]
+            for chunk in ModelTools._split_list(set(ids), 500):
+                for n in node_class.objects.filter(pk__in = chunk):
+                    if identity_map is not None:
+                        n = identity_map.add(n)
+                    all_nodes[n.pk] = n
+
+        # everything named in a path can be had at once
+        path_ids = set()
+        for n in nodes:
+            path_ids.update(n._get_path_ids() or [])
+        if len(path_ids) > 0:
+            fetch(path_ids)
+
+        # then go up a generation at a time for whatever is
+        # left, linking as we go
+        visited = set()
+        pending = nodes
+        while len(pending) > 0:
+            fetch([ n.parent_id for n in pending if n.parent_id is not None ])
+            next_pending = []
+            for n in pending:
+                visited.add(n.pk)
+                if n.parent_id in all_nodes:
+                    n.parent = all_nodes[n.parent_id]
+                    if n.parent_id not in visited:
+                        visited.add(n.parent_id)
+                        next_pending.append(n.parent)
+            pending = next_pending
+
+        for n in nodes:
+            n.parents_list = []
+            seen = set([ n.pk ])
+            node = n
+            while node.parent_id in all_nodes and node.parent_id not in seen:
+                node = all_nodes[node.parent_id]
+                seen.add(node.pk)
+                n.parents_list.append(node)
+
+        return all_nodes
+
     # and, as a special-case method, we allow fetching
     # the children of one specific node (ourselves)
     def get_children(self, generations = 1, q = None, order_by = None, select_related = None):
@@ -585,7 +1326,7 @@ class SimpleTreeMixin(object):
             order_by = [ 'display_order' ]
         
         # we need to identify the model to query
-        if isinstance(nodes, models.Model):
+        if isinstance(nodes, type) and issubclass(nodes, models.Model):
             node_class = nodes
             node_ids = None
             nodes = None
@@ -622,6 +1363,11 @@ class SimpleTreeMixin(object):
                 order_by = [ select_related ]
             children = children.select_related(*select_related)
         
+        # share instances with anything else loaded this request
+        identity_map = IdentityMap.get_active()
+        if identity_map is not None:
+            children = [ identity_map.add(n) for n in children ]
+
         # create a quick index to all the children and
         # (if present) the original parents
         node_index = dict([ (n.id,n) for n in children ])
@@ -652,3 +1398,26 @@ class SimpleTreeMixin(object):
                 n.parent.children_list.append(n)
         
         return roots
+
+    # load the whole tree (or the subtree under root, which
+    # can be a node or its ID) with one query, as a
+    # TreeSnapshot that can answer ancestor, sibling, depth and
+    # subtree questions without going back to the database
+    #
+    #   tree = Category.load_tree()
+    #   for category in tree.get_parents(current):
+    #       ...
+    #
+    @classmethod
+    def load_tree(cls, root = None, q = None, order_by = None, select_related = None):
+        return TreeSnapshot.load(cls, root = root, q = q, order_by = order_by, select_related = select_related)
+
+    # the same, but shared: the tree is loaded once and kept
+    # until a node is saved, deleted or moved (see TreeCache)
+    #
+    # NOTE: the nodes are shared with every other request; don't
+    # change them.
+    #
+    @classmethod
+    def get_cached_tree(cls, root = None):
+        return TreeCache.get_tree(cls, root = root)
@@ -1,7 +1,214 @@
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
+from django.db.models import AutoField, Count, ManyToManyField, Model, Q
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.manager import Manager, QuerySet
 from sculpt.common import Enumeration
+from sculpt.model_tools.backends import get_upsert_dialect, supports_window_functions
+from sculpt.model_tools.identity_map import IdentityMap
+from sculpt.model_tools.metadata import ModelMetadata
+from sculpt.model_tools.mixins import AutoHashMixin
+import operator
+
+# _RelatedLookup
+#
+# Works out, from the descriptor Django puts on a model class
+# for a related field, how to fetch the related records for a
+# batch of parent IDs and how to tell which parent each of
+# those records belongs to. This is the part of fetch_related
+# that has to poke at Django internals, so we keep it in one
+# place.
+#
+# Three kinds of relation are understood:
+#
+#   1. A reverse ForeignKey (e.g. parent.children). We query
+#      the model that has the ForeignKey and the parent ID is
+#      the ForeignKey's own column.
+#
+#   2. A ManyToManyField, from either side. We query the model
+#      on the far side, filtered through the intermediate
+#      table; that join is already there, so we pull the
+#      parent ID (and any through_fields) from it with an
+#      extra select rather than joining it again.
+#
+#   3. A GenericRelation. We query the model with the
+#      GenericForeignKey, filtered by content type, and the
+#      parent ID is its object ID field (which may not be the
+#      same type as our primary key, so we convert it).
+#
+# parent_id_attname is where the parent ID lives on a fetched
+# record, parent_id_key is its name in values()/values_list(),
+# and parent_id_field is the model field it comes from (if
+# any) which must not be deferred. parent_id_column is that
+# field's column in the related model's own table, if it has
+# one.
+#
+class _RelatedLookup(object):
+
+    # the attribute an extra select puts the parent ID in, for
+    # relations where it's not already a field on the record
+    PARENT_ID_ATTR = '_fetch_related_parent_id'
+
+    def __init__(self, model_class, related_field, through_fields = None):
+        descriptor = getattr(model_class, related_field)
+
+        self.filters = {}
+        self.extra_select = None
+        self.parent_id_field = None
+        self.parent_id_column = None
+        self.parent_id_converter = None
+        self.link_name = None
+
+        if hasattr(descriptor, 'related'):
+            # reverse side of a ForeignKey or ManyToManyField
+            field = descriptor.related.field
+            reverse = True
+        else:
+            # forward side of a ManyToManyField, or a
+            # GenericRelation
+            field = descriptor.field
+            reverse = False
+
+        if isinstance(field, ManyToManyField):
+            through = field.rel.through
+            if reverse:
+                self.model = field.model
+                source_field_name = field.m2m_reverse_field_name()
+                query_name = field.name
+            else:
+                self.model = field.rel.to
+                source_field_name = field.m2m_field_name()
+                query_name = field.related_query_name()
+
+            self.id_lookup = query_name + '__in'
+            self.parent_id_attname = self.PARENT_ID_ATTR
+            self.parent_id_key = self.PARENT_ID_ATTR
+            self.extra_select = { self.PARENT_ID_ATTR: self._get_column(through, source_field_name) }
+
+            if through_fields is not None:
+                if not isinstance(through_fields, dict):
+                    through_fields = dict([ (f,f) for f in through_fields ])
+                for attr_name, through_field_name in through_fields.iteritems():
+                    self.extra_select[attr_name] = self._get_column(through, through_field_name)
+
+        elif hasattr(field, 'object_id_field_name'):
+            # GenericRelation; contenttypes is an optional app,
+            # so we don't import it unless we actually need it
+            from django.contrib.contenttypes.fields import GenericForeignKey
+            from django.contrib.contenttypes.models import ContentType
+
+            self.model = field.rel.to
+            self.id_lookup = field.object_id_field_name + '__in'
+            self.parent_id_attname = field.object_id_field_name
+            self.parent_id_field = field.object_id_field_name
+            self.parent_id_key = field.object_id_field_name
+            self.parent_id_column = self.model._meta.get_field(field.object_id_field_name).column
+            self.parent_id_converter = model_class._meta.pk.to_python
+            self.filters[field.content_type_field_name] = ContentType.objects.get_for_model(model_class, for_concrete_model = field.for_concrete_model)
+
+            # if there is a matching GenericForeignKey we can
+            # prime its cache so it doesn't refetch the parent
+            for f in self.model._meta.virtual_fields:
+                if isinstance(f, GenericForeignKey) and f.ct_field == field.content_type_field_name and f.fk_field == field.object_id_field_name:
+                    self.link_name = f.cache_attr
+
+        elif reverse:
+            self.model = field.model
+            self.id_lookup = field.name + '_id__in'
+            self.parent_id_attname = field.attname
+            self.parent_id_field = field.name
+            self.parent_id_key = field.name
+            self.parent_id_column = field.column
+            self.link_name = field.name
+
+        else:
+            raise TypeError('%s.%s is not a reverse ForeignKey, ManyToManyField or GenericRelation' % (model_class.__name__, related_field))
+
+    # the fully-qualified (and quoted) column name for a field
+    # on the intermediate table of a many-to-many relation
+    @classmethod
+    def _get_column(cls, model_class, field_name):
+        qn = connection.ops.quote_name
+        return '%s.%s' % (qn(model_class._meta.db_table), qn(model_class._meta.get_field(field_name).column))
+
+    # the base QuerySet for the related records of a batch of
+    # parent IDs; the caller adds its own filtering and ordering
+    def get_queryset(self, id_list):
+        filters = dict(self.filters)
+        filters[self.id_lookup] = id_list
+        rqs = self.model.objects.filter(**filters)
+        if self.extra_select is not None:
+            rqs = rqs.extra(select = self.extra_select)
+        return rqs
+
+    # restrict a related QuerySet to the first limit records
+    # for each parent, in order_by order, with a window
+    # function; returns None if that can't be done here, in
+    # which case the caller has to trim the lists itself
+    #
+    # Only plain, non-relation field names (optionally with a
+    # leading -) can be translated into the window's ORDER BY,
+    # and the parent ID has to be a column of the related table
+    # (so this is not available for many-to-many relations).
+    #
+    # The ranking is done on the records that pass the
+    # related QuerySet's filters, so q is honored; we get the
+    # primary keys of those as a subquery and rank just them.
+    #
+    def limit_queryset(self, rqs, limit, order_by):
+        if self.parent_id_column is None or not supports_window_functions(connection):
+            return None
+
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        if order_by is None:
+            order_by = list(opts.ordering)
+
+        # always finish with the primary key so the ranking
+        # is repeatable
+        order_columns = []
+        for name in list(order_by) + [ 'pk' ]:
+            if not isinstance(name, basestring):
+                return None
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name == 'pk':
+                field = opts.pk
+            else:
+                try:
+                    field = opts.get_field(name)
+                except FieldDoesNotExist:
+                    return None
+                # Django orders a relation by the related
+                # model's ordering, not by the ID column
+                if field.rel is not None:
+                    return None
+            order_columns.append(qn(field.column) + (' DESC' if descending else ' ASC'))
+
+        filtered_sql, filtered_params = rqs.order_by().values_list('pk').query.sql_with_params()
+        where = (
+                '%(table)s.%(pk)s IN (SELECT ranked_pk FROM ('
+                    'SELECT %(pk)s AS ranked_pk, ROW_NUMBER() OVER (PARTITION BY %(parent)s ORDER BY %(order)s) AS ranked_row '
+                    'FROM %(table)s WHERE %(pk)s IN (%(filtered)s)'
+                ') ranked WHERE ranked_row <= %%s)'
+            ) % {
+                'table': qn(opts.db_table),
+                'pk': qn(opts.pk.column),
+                'parent': qn(self.parent_id_column),
+                'order': ', '.join(order_columns),
+                'filtered': filtered_sql,
+            }
+        return rqs.extra(where = [ where ], params = list(filtered_params) + [ limit ])
+
+    # the ID of the parent a related record was fetched for,
+    # given the raw value from the record (or from its values()
+    # dict or values_list() tuple)
+    def to_parent_id(self, value):
+        if self.parent_id_converter is not None:
+            value = self.parent_id_converter(value)
+        return value
+
 
 # ModelTools
 #
@@ -54,8 +261,9 @@ class ModelTools(object):
     # NOTE: returns the SAME (modified) QuerySet.
     # NOTE: only basic customization of the QuerySet is possible;
     # at some point we may need to allow a callable to be passed
-    # in that will modify the QuerySet, to allow defer() or
-    # extra() or other fun things.
+    # in that will modify the QuerySet, to allow extra() or
+    # other fun things. (only() and defer() are covered; see
+    # below.)
     #
     # NOTE: Django as of v1.4 does offer prefetch_related which
     # provides similar functionality, including nested lookups,
@@ -63,8 +271,67 @@ class ModelTools(object):
     # Q object to filter the results. This function now has a
     # select_related method.
     #
+    # For very large parent lists (tens of thousands of IDs)
+    # a single IN clause runs into database parameter limits
+    # and the whole related QuerySet gets loaded into memory
+    # before any of it is sorted out. Pass chunk_size to split
+    # the ID list into batches of at most that many IDs; each
+    # batch is a separate query and is streamed with
+    # .iterator() so rows are handed to their parents as they
+    # arrive, rather than being cached on the QuerySet. Since
+    # all the related records for one parent are in the same
+    # batch, the sort order within each list is unchanged.
+    #
+    # related_field may name a reverse ForeignKey (the usual
+    # case), either side of a ManyToManyField, or a
+    # GenericRelation. Many-to-many relations are fetched in
+    # one query that joins through the intermediate table
+    # once; q, order_by and select_related apply to the far
+    # side of the relation, just as they would for a reverse
+    # ForeignKey. If the intermediate table has columns of its
+    # own that you want, pass their names in through_fields
+    # (or a dict of attribute name to through field name) and
+    # they will be set as attributes on each related record.
+    # Those are raw database values, and since the same
+    # record can be related to several parents, each parent
+    # gets its own copy of the record. There is no reverse
+    # link to fix for many-to-many relations, so
+    # fix_reverse_links is ignored for them.
+    #
+    # When only a few columns of the related records are
+    # needed, pass a list of field names in only or defer and
+    # they are handed to the QuerySet methods of the same
+    # name. (The field that identifies the parent is never
+    # deferred, or finding the parent would cost a query per
+    # record.) To skip building model instances altogether,
+    # pass a list of field names in values to get a dict per
+    # related record, or in values_list to get a tuple per
+    # related record, just as Django's values() and
+    # values_list() would. Those are much cheaper to build and
+    # to hold on to for wide tables. Through-table columns can
+    # be included by naming them (or the attribute names you
+    # gave them in through_fields) in the list. There is no
+    # record to link back to the parent in these modes, so
+    # fix_reverse_links and select_related are ignored.
+    #
+    # If you only want the first few related records for each
+    # parent (say, the latest 5 comments on each post) pass
+    # limit_per_parent and each list will hold at most that
+    # many records, in order_by order. Where the database
+    # supports window functions the limit is applied in SQL,
+    # so the rest of the records are never sent; otherwise
+    # (or for many-to-many relations, or an order_by that
+    # reaches into other tables) every record is still
+    # fetched but the extras are dropped as they arrive.
+    #
+    # If an IdentityMap is active, each related record that is
+    # already known is replaced by the known instance (and new
+    # ones are added to the map). That's skipped when
+    # through_fields are requested, since the through values
+    # differ from one parent to the next.
+    #
     @classmethod
-    def fetch_related(cls, qs, related_field, q = None, order_by = None, results_field = None, id_list = None, select_related = None, fix_reverse_links = True):
+    def fetch_related(cls, qs, related_field, q = None, order_by = None, results_field = None, id_list = None, select_related = None, fix_reverse_links = True, chunk_size = None, through_fields = None, only = None, defer = None, values = None, values_list = None, limit_per_parent = None):
         if results_field == None:
             results_field = related_field + '_list'
 
@@ -113,60 +380,279 @@ class ModelTools(object):
         # or not). We can still get the class name, but we don't
         # include these in the list of IDs we query for.
 
-        # take the first object and get the relationship, then
-        # extract the model class object and the reverse field
-        # name (which we need to find the parent object)
-        relationship = getattr(qs[0].__class__, related_field).related
-        related_model = relationship.model
-        related_model_field_name = relationship.field.name
-        related_model_field_id = relationship.field.attname
-
-        # fetch all the related records
-
-        # we can't use Django's in_bulk() here because we want
-        # to return records in correct sorted order, and the
-        # in_bulk() returns a dict; we just use a normal
-        # QuerySet
-        # and the odd **{} is idiomatic Python for constructing
-        # function parameter names on the fly
-        rqs = related_model.objects.filter(**{ related_model_field_name +'_id__in': id_list })
-
-        if q is not None:
-            rqs = rqs.filter(q)
-
-        if order_by is not None:
-            # a common mistake is to pass a single field name
-            # instead of a list; catch this and rework it
-            if isinstance(order_by, basestring):
-                order_by = [ order_by ]
-            rqs = rqs.order_by(*order_by)
-
-        if select_related is not None:
-            # a common mistake is to pass a single field name
-            # instead of a list; catch this and rework it
-            if isinstance(select_related, basestring):
-                order_by = [ select_related ]
-            rqs = rqs.select_related(*select_related)
+        # take the first object and get the relationship, which
+        # knows what model to query and how to find the parent
+        # of each record it returns
+        relationship = _RelatedLookup(qs[0].__class__, related_field, through_fields)
+
+        # a common mistake is to pass a single field name
+        # instead of a list; catch this and rework it
+        if isinstance(order_by, basestring):
+            order_by = [ order_by ]
+        if isinstance(select_related, basestring):
+            select_related = [ select_related ]
+        if isinstance(only, basestring):
+            only = [ only ]
+        if isinstance(defer, basestring):
+            defer = [ defer ]
+        if isinstance(values, basestring):
+            values = [ values ]
+        if isinstance(values_list, basestring):
+            values_list = [ values_list ]
+
+        # make sure we never defer the field that tells us who
+        # the parent is
+        parent_id_field = relationship.parent_id_field
+        if only is not None and parent_id_field is not None:
+            only = list(only) + [ parent_id_field ]
+        if defer is not None:
+            defer = [ f for f in defer if f != parent_id_field ]
+
+        # in values mode we need the parent ID in each dict, but
+        # we don't leave it there unless it was asked for
+        parent_id_key = relationship.parent_id_key
+        if values is not None:
+            strip_parent_id = parent_id_key not in values
+
+        # share instances with anything else loaded this request
+        identity_map = None
+        if values is None and values_list is None and through_fields is None:
+            identity_map = IdentityMap.get_active()
 
         # place each related record with its proper parent
 
         # to do this efficiently, we need a map of parent ID
-        # to object; this dense bit of idiomatic Python does it
-        qs_map = dict([ (r.id,r) for r in qs ])
-
-        # now sift each related record (rr)
-        # while we are at it, we will (if asked) link the
-        # child record back to its parent, because Django
-        # doesn't know when it fetches the related records
-        # that we already have the original record
-        for rr in rqs:
-            r = qs_map[getattr(rr, related_model_field_id)] # get parent record
-            getattr(r, results_field).append(rr)            # append results to list
-            if fix_reverse_links:
-                setattr(rr, related_model_field_name, r)    # link related object back to its parent
+        # to object; since the same record may appear more than
+        # once (e.g. the results of a many-to-many fetch) we
+        # map each ID to a list of objects
+        qs_map = {}
+        for r in qs:
+            qs_map.setdefault(r.id, []).append(r)
+
+        # fetch all the related records, one batch of parent
+        # IDs at a time (a single batch unless we're chunking)
+        if chunk_size is None:
+            id_chunks = [ id_list ]
+        else:
+            id_chunks = cls._split_list(id_list, chunk_size)
+
+        for id_chunk in id_chunks:
+
+            # we can't use Django's in_bulk() here because we want
+            # to return records in correct sorted order, and the
+            # in_bulk() returns a dict; we just use a normal
+            # QuerySet
+            rqs = relationship.get_queryset(id_chunk)
+
+            if q is not None:
+                rqs = rqs.filter(q)
+
+            if order_by is not None:
+                rqs = rqs.order_by(*order_by)
+
+            if limit_per_parent is not None:
+                limited_rqs = relationship.limit_queryset(rqs, limit_per_parent, order_by)
+                if limited_rqs is not None:
+                    rqs = limited_rqs
+
+            if values is not None:
+                rqs = rqs.values(*(list(values) + [ parent_id_key ]))
+
+            elif values_list is not None:
+                rqs = rqs.values_list(*([ parent_id_key ] + list(values_list)))
+
+            else:
+                if select_related is not None:
+                    rqs = rqs.select_related(*select_related)
+                if only is not None:
+                    rqs = rqs.only(*only)
+                if defer is not None:
+                    rqs = rqs.defer(*defer)
+
+            if chunk_size is not None:
+                # don't let the QuerySet cache the rows; we only
+                # need each one long enough to file it away
+                rqs = rqs.iterator()
+
+            # now sift each related record (rr)
+            # while we are at it, we will (if asked) link the
+            # child record back to its parent, because Django
+            # doesn't know when it fetches the related records
+            # that we already have the original record
+            for rr in rqs:
+                if values is not None:
+                    if strip_parent_id:
+                        parent_id = rr.pop(parent_id_key)
+                    else:
+                        parent_id = rr[parent_id_key]
+                elif values_list is not None:
+                    parent_id = rr[0]
+                    rr = rr[1:]
+                else:
+                    parent_id = getattr(rr, relationship.parent_id_attname)
+                    if identity_map is not None:
+                        rr = identity_map.add(rr)
+
+                for r in qs_map[relationship.to_parent_id(parent_id)]:     # get parent record(s)
+                    results = getattr(r, results_field)
+                    if limit_per_parent is not None and len(results) >= limit_per_parent:
+                        continue                                            # this parent's list is full
+                    results.append(rr)                                      # append results to list
+                    if fix_reverse_links and relationship.link_name is not None and values is None and values_list is None:
+                        setattr(rr, relationship.link_name, r)              # link related object back to its parent
 
         return qs
 
+    # fetch_related_aggregates
+    #
+    # A lot of the time we don't want the related records at
+    # all, just how many there are or the total of one of
+    # their columns; loading every record to compute
+    # len(obj.children_list) is a waste. This takes the same
+    # QuerySet (or list), related field, q and id_list as
+    # fetch_related, plus a dict of Django aggregates over the
+    # related model, and runs one GROUP BY query to compute
+    # them for every parent at once, e.g.
+    #
+    #   ModelTools.fetch_related_aggregates(posts, 'comments', {
+    #           'comment_count': Count('id'),
+    #           'latest_comment': Max('date_created'),
+    #       }, q = Q(is_approved = True))
+    #
+    # Each aggregate is set as an attribute on each parent.
+    # Parents with no related records get 0 for a Count and
+    # None for anything else, just as the database would give
+    # for an empty set.
+    #
+    # NOTE: returns the SAME (modified) QuerySet.
+    #
+    @classmethod
+    def fetch_related_aggregates(cls, qs, related_field, aggregates, q = None, id_list = None, chunk_size = None):
+        if id_list == None:
+            id_list = [ r.id for r in qs if r.id != None ]
+
+        # set the empty-set values first, in case we exit early
+        # or a parent has no related records
+        for r in qs:
+            for name, aggregate in aggregates.iteritems():
+                setattr(r, name, 0 if isinstance(aggregate, Count) else None)
+
+        if len(id_list) == 0:
+            return qs
+
+        relationship = _RelatedLookup(qs[0].__class__, related_field)
+
+        qs_map = {}
+        for r in qs:
+            qs_map.setdefault(r.id, []).append(r)
+
+        if chunk_size is None:
+            id_chunks = [ id_list ]
+        else:
+            id_chunks = cls._split_list(id_list, chunk_size)
+
+        for id_chunk in id_chunks:
+            rqs = relationship.get_queryset(id_chunk)
+
+            if q is not None:
+                rqs = rqs.filter(q)
+
+            # clear any default ordering, which would otherwise
+            # end up in the GROUP BY
+            rqs = rqs.order_by().values(relationship.parent_id_key).annotate(**aggregates)
+
+            for row in rqs:
+                for r in qs_map[relationship.to_parent_id(row[relationship.parent_id_key])]:
+                    for name in aggregates:
+                        setattr(r, name, row[name])
+
+        return qs
+
+    # fetch_related_path
+    #
+    # fetch_related works on one level of related records at a
+    # time, so loading parent -> children -> grandchildren means
+    # calling it once per level and gathering up each level's
+    # lists to pass to the next call. This does that for you.
+    # Pass a relation path in the usual Django style, e.g.
+    #
+    #   ModelTools.fetch_related_path(customers, 'orders__lines__allocations')
+    #
+    # and each level is fetched with exactly one query (or one
+    # per chunk, if chunk_size is given) and stored in the usual
+    # related_field + '_list' attribute on every record at the
+    # level above, all the way down.
+    #
+    # q, order_by, select_related and through_fields can be
+    # given per level as a dict keyed by the path down to that
+    # level:
+    #
+    #   ModelTools.fetch_related_path(customers, 'orders__lines',
+    #       q = { 'orders': Q(status = Order.STATUSES.OPEN) },
+    #       order_by = { 'orders': '-date_created', 'orders__lines': 'position' },
+    #   )
+    #
+    # If you pass a plain value instead of a dict, it applies
+    # to the last level only.
+    #
+    # NOTE: returns the SAME (modified) QuerySet.
+    #
+    @classmethod
+    def fetch_related_path(cls, qs, related_path, q = None, order_by = None, select_related = None, fix_reverse_links = True, chunk_size = None, through_fields = None):
+        records = qs
+        level_path = []
+        for related_field in related_path.split('__'):
+            level_path.append(related_field)
+            path = '__'.join(level_path)
+
+            cls.fetch_related(
+                    records, related_field,
+                    q = cls._get_path_option(q, path, related_path),
+                    order_by = cls._get_path_option(order_by, path, related_path),
+                    select_related = cls._get_path_option(select_related, path, related_path),
+                    fix_reverse_links = fix_reverse_links,
+                    chunk_size = chunk_size,
+                    through_fields = cls._get_path_option(through_fields, path, related_path),
+                )
+
+            # the records we just fetched, across all of the
+            # records at this level, become the parents for
+            # the next level down
+            results_field = related_field + '_list'
+            records = [ rr for r in records for rr in getattr(r, results_field) ]
+
+        return qs
+
+    # pick out the option that applies to one level of a
+    # fetch_related_path call
+    @classmethod
+    def _get_path_option(cls, option, path, related_path):
+        if isinstance(option, dict):
+            return option.get(path)
+        elif path == related_path:
+            return option
+        else:
+            return None
+
+    # split a list into consecutive pieces of at most size
+    # items each; used to keep IN clauses to a sane length
+    @classmethod
+    def _split_list(cls, items, size):
+        if size < 1:
+            raise ValueError('chunk size must be at least 1, not %r' % size)
+        items = list(items)
+        for i in xrange(0, len(items), size):
+            yield items[i:i + size]
+
+    # the chunk size to actually use when each record (or
+    # entry) in a chunk adds params_per_record parameters to a
+    # query: chunk_size, unless the database limits how many
+    # parameters a query may have (SQLite, typically 999)
+    @classmethod
+    def _get_batch_size(cls, params_per_record, records, chunk_size):
+        limit = connection.ops.bulk_batch_size([ None ] * max(params_per_record, 1), records)
+        return max(1, min(chunk_size, limit))
+
     # update_or_create
     #
     # Django offers a useful get_or_create method which will
@@ -225,6 +711,370 @@ class ModelTools(object):
 
         return (record, created, dirty)
 
+    # upsert
+    #
+    # update_or_create reads before it writes, which costs two
+    # or three round trips and still races if two processes
+    # go after the same record at once (both see nothing, both
+    # insert, one fails). Most databases can do the whole
+    # thing in one statement; this uses that where possible.
+    #
+    # The arguments mean the same as for update_or_create:
+    # the lookup fields identify the record and MUST match a
+    # unique constraint (the database uses that constraint to
+    # detect the existing record), defaults are only used when
+    # inserting, and updates are used for both inserting and
+    # updating.
+    #
+    #   created, updated = ModelTools.upsert(Product, sku = sku,
+    #       defaults = { 'date_added': now }, updates = { 'price': price })
+    #
+    # Returns (created, updated); updated is only True if one
+    # of the updates actually changed a value. Unlike
+    # update_or_create, the record itself is not returned
+    # (that would cost another query).
+    #
+    # On databases without a native statement (see
+    # get_upsert_dialect) this falls back to update_or_create.
+    #
+    # NOTE: save() is not called and no signals are sent, but
+    # field defaults and pre_save hooks (e.g. auto_now_add)
+    # are applied to inserted records just as save() would.
+    #
+    # NOTE: MySQL uses whichever unique key conflicts, and can
+    # only tell an insert from an unchanged record if the
+    # table has an auto-increment primary key; otherwise
+    # created is always False. SQLite uses two statements in
+    # one transaction, which is still race-free there since
+    # SQLite only allows one writer at a time.
+    #
+    @classmethod
+    def upsert(cls, model_class, **kwargs):
+        # these parameters can't be listed in the formal list
+        # or Python will attempt to fill them with positional
+        # parameters, which we DO NOT WANT.
+        defaults = kwargs.pop('defaults', {})
+        updates = kwargs.pop('updates', {})
+        lookup = kwargs
+
+        dialect = get_upsert_dialect(connection)
+        if dialect is None:
+            record, created, updated = cls.update_or_create(model_class, defaults = dict(defaults), updates = updates, **lookup)
+            return (created, updated)
+
+        opts = model_class._meta
+        metadata = ModelMetadata.get(model_class)
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+
+        # build an unsaved record so that field defaults and
+        # pre_save hooks fill in everything else, just as an
+        # ordinary insert would
+        fields = dict(lookup)
+        fields.update(defaults)
+        fields.update(updates)
+        record = model_class(**fields)
+
+        insert_fields = [ f for f in metadata.concrete_fields if not isinstance(f, AutoField) ]
+        insert_values = [ f.get_db_prep_save(f.pre_save(record, True), connection) for f in insert_fields ]
+        key_fields = [ metadata.get_field(name) for name in lookup ]
+        update_fields = [ metadata.get_field(name) for name in updates ]
+
+        insert_sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table,
+                ', '.join([ qn(f.column) for f in insert_fields ]),
+                ', '.join([ '%s' ] * len(insert_fields)),
+            )
+        key_columns = ', '.join([ qn(f.column) for f in key_fields ])
+
+        cursor = connection.cursor()
+
+        if dialect == 'postgresql':
+            # the WHERE skips rewriting unchanged rows, in which
+            # case nothing is returned; xmax is 0 for a row that
+            # this statement inserted
+            if len(update_fields) > 0:
+                action = 'DO UPDATE SET %s WHERE %s' % (
+                        ', '.join([ '%s = EXCLUDED.%s' % (qn(f.column), qn(f.column)) for f in update_fields ]),
+                        ' OR '.join([ '%s.%s IS DISTINCT FROM EXCLUDED.%s' % (table, qn(f.column), qn(f.column)) for f in update_fields ]),
+                    )
+            else:
+                action = 'DO NOTHING'
+            cursor.execute('%s ON CONFLICT (%s) %s RETURNING (xmax = 0)' % (insert_sql, key_columns, action), insert_values)
+            row = cursor.fetchone()
+            if row is None:
+                return (False, False)
+            return (bool(row[0]), not row[0])
+
+        elif dialect == 'mysql':
+            # affected rows is 2 for a changed row; with
+            # Django's FOUND_ROWS connection flag, it's 1 for
+            # both an insert and an unchanged row, but only an
+            # insert generates an ID
+            if len(update_fields) > 0:
+                action = ', '.join([ '%s = VALUES(%s)' % (qn(f.column), qn(f.column)) for f in update_fields ])
+            else:
+                action = '%s = %s' % (qn(opts.pk.column), qn(opts.pk.column))
+            cursor.execute('%s ON DUPLICATE KEY UPDATE %s' % (insert_sql, action), insert_values)
+            if cursor.rowcount == 2:
+                return (False, True)
+            return (bool(cursor.lastrowid), False)
+
+        else:
+            with transaction.atomic():
+                cursor.execute('%s ON CONFLICT (%s) DO NOTHING' % (insert_sql, key_columns), insert_values)
+                if cursor.rowcount == 1:
+                    return (True, False)
+                if len(update_fields) == 0:
+                    return (False, False)
+
+                params = [ f.get_db_prep_save(getattr(record, f.attname), connection) for f in update_fields ]
+                params.extend([ f.get_db_prep_save(getattr(record, f.attname), connection) for f in key_fields ])
+                params.extend([ f.get_db_prep_save(getattr(record, f.attname), connection) for f in update_fields ])
+                cursor.execute(
+                        'UPDATE %s SET %s WHERE %s AND (%s)' % (
+                            table,
+                            ', '.join([ '%s = %%s' % qn(f.column) for f in update_fields ]),
+                            ' AND '.join([ '%s = %%s' % qn(f.column) for f in key_fields ]),
+                            ' OR '.join([ '%s IS NOT %%s' % qn(f.column) for f in update_fields ]),
+                        ),
+                        params,
+                    )
+                return (False, cursor.rowcount > 0)
+
+    # bulk_update_or_create
+    #
+    # update_or_create costs at least one query per record, and
+    # two or three when a record has to be created or updated;
+    # for a big import that's far too many round trips. This
+    # does the same job for a whole list of entries, each a
+    # tuple of (lookup, defaults, updates) dicts with the same
+    # meaning as update_or_create's keyword arguments, e.g.
+    #
+    #   ModelTools.bulk_update_or_create(Product, [
+    #           ({ 'sku': row['sku'] }, { 'date_added': now }, { 'price': row['price'] })
+    #           for row in rows
+    #       ])
+    #
+    # For each chunk of entries there is one query to fetch the
+    # existing records, one bulk_create for the missing ones
+    # (plus one query to find out their IDs, on databases that
+    # don't report them) and one UPDATE for each distinct set
+    # of changed fields. Only records whose updates actually
+    # change something are written, and only those fields.
+    #
+    # Returns a list of (record, created, updated) tuples, one
+    # per entry and in the same order.
+    #
+    # NOTE: lookups must be plain field = value pairs (no __
+    # lookups) since we have to match the records we fetch
+    # back up with the entries in Python. Values are compared
+    # after the field's own to_python conversion, so a
+    # case-insensitive column may still fail to match.
+    #
+    # NOTE: if the same lookup appears more than once, every
+    # entry refers to the same record and later updates are
+    # applied on top of earlier ones.
+    #
+    # NOTE: new records are created with bulk_create, so save()
+    # is not called and no signals are sent. If you pass a
+    # related manager, it is used to find existing records but
+    # the lookups or defaults must still set the relation for
+    # new ones.
+    #
+    # NOTE: each chunk is written in its own transaction.
+    #
+    @classmethod
+    def bulk_update_or_create(cls, model_or_manager, entries, chunk_size = 500):
+        if isinstance(model_or_manager, Manager):
+            manager = model_or_manager
+        else:
+            manager = model_or_manager.objects  # use default manager
+        model_class = manager.model
+        metadata = ModelMetadata.get(model_class)
+
+        # the lookups for a whole chunk go into one query
+        entries = list(entries)
+        if len(entries) > 0:
+            chunk_size = cls._get_batch_size(max([ len(lookup) for lookup, defaults, updates in entries ]), entries, chunk_size)
+
+        results = []
+        for chunk in cls._split_list(entries, chunk_size):
+            with transaction.atomic():
+                results.extend(cls._bulk_update_or_create_chunk(manager, model_class, metadata, chunk))
+        return results
+
+    @classmethod
+    def _bulk_update_or_create_chunk(cls, manager, model_class, metadata, entries):
+        # normalize the entries and work out the key that each
+        # one's record will be found under
+        lookups = []
+        for lookup, defaults, updates in entries:
+            key = cls._get_lookup_key(metadata, lookup)
+            lookups.append((key, lookup, defaults or {}, updates or {}))
+
+        # fetch all the existing records in one query
+        index = {}
+        key_names = set([ key[0] for key, _, _, _ in lookups ])
+        existing = manager.filter(reduce(operator.or_, [ Q(**lookup) for _, lookup, _, _ in lookups ]))
+        for record in existing:
+            for names in key_names:
+                index[cls._get_record_key(metadata, record, names)] = record
+
+        results = []
+        new_records = []
+        new_keys = {}
+        dirty_fields = {}
+        for key, lookup, defaults, updates in lookups:
+            record = index.get(key)
+
+            if record is None:
+                # missing; we create it with everything
+                fields = dict(lookup)
+                fields.update(defaults)
+                fields.update(updates)
+                record = model_class(**fields)
+                index[key] = record
+                new_records.append(record)
+                new_keys[id(record)] = (key, lookup)
+                results.append((record, True, False))
+                continue
+
+            # update it in memory, noting which fields changed;
+            # if it's one we're about to create, those changes
+            # just go into the insert
+            dirty = False
+            for k,v in updates.iteritems():
+                if getattr(record, k) != v:
+                    dirty = True
+                    setattr(record, k, v)
+                    if id(record) not in new_keys:
+                        dirty_fields.setdefault(id(record), (record, set()))[1].add(k)
+            results.append((record, False, dirty))
+
+        if len(new_records) > 0:
+            manager.model.objects.bulk_create(new_records)
+
+            # most databases don't tell Django the IDs of the
+            # records it inserted, so we have to go and look
+            if new_records[0].pk is None:
+                created_index = {}
+                created = manager.filter(reduce(operator.or_, [ Q(**lookup) for key, lookup in new_keys.itervalues() ]))
+                for record in created:
+                    for names in key_names:
+                        created_index[cls._get_record_key(metadata, record, names)] = record
+                for record in new_records:
+                    created_record = created_index.get(new_keys[id(record)][0])
+                    if created_record is not None:
+                        record.pk = created_record.pk
+                        record._state.adding = False
+
+        # write the changed fields, one UPDATE per combination
+        groups = {}
+        for record, fields in dirty_fields.itervalues():
+            groups.setdefault(frozenset(fields), []).append(record)
+        for fields, records in groups.iteritems():
+            cls.bulk_update(records, fields)
+
+        return results
+
+    # given a lookup dict, return a hashable key identifying
+    # the record it refers to; model instances are replaced
+    # by their primary keys and everything else is converted
+    # the way the field itself would (for a foreign key, the
+    # way the field it points at would, since ForeignKey's own
+    # to_python leaves e.g. '7' as a string)
+    @classmethod
+    def _get_lookup_key(cls, metadata, lookup):
+        names = tuple(sorted(lookup.keys()))
+        values = []
+        for name in names:
+            field = metadata.get_field(name)
+            v = lookup[name]
+            if isinstance(v, Model):
+                v = v.pk
+            if v is not None:
+                if field.rel is not None:
+                    v = field.rel.get_related_field().to_python(v)
+                else:
+                    v = field.to_python(v)
+            values.append(v)
+        return (names, tuple(values))
+
+    # the same key, but for a record we fetched
+    @classmethod
+    def _get_record_key(cls, metadata, record, names):
+        return (names, tuple([ getattr(record, metadata.get_field(name).attname) for name in names ]))
+
+    # bulk_update
+    #
+    # Django can bulk_create but it can't bulk update: a
+    # QuerySet update() sets every record to the same value,
+    # and otherwise it's one save() per record. This writes the
+    # named fields of a list of records (all of the same model)
+    # with a single UPDATE per chunk, using a CASE on the
+    # primary key to give each record its own value:
+    #
+    #   UPDATE t SET a = CASE id WHEN 1 THEN ... WHEN 2 THEN ... END, ...
+    #   WHERE id IN (1, 2, ...)
+    #
+    # Fields may be named by name or attname. As with
+    # update_fields, save() is not called, so pre_save hooks
+    # (e.g. auto_now) don't run and no signals are sent.
+    #
+    # NOTE: each record adds two parameters per field to the
+    # query, so on databases that limit the number of
+    # parameters (SQLite) chunks are made smaller than
+    # chunk_size to fit.
+    #
+    # Returns the number of rows updated.
+    #
+    @classmethod
+    def bulk_update(cls, records, fields, chunk_size = 500):
+        records = [ r for r in records if r.pk is not None ]
+        if len(records) == 0 or len(fields) == 0:
+            return 0
+
+        opts = records[0]._meta.concrete_model._meta
+        metadata = ModelMetadata.get(records[0].__class__)
+        qn = connection.ops.quote_name
+        fields = [ metadata.get_field(name) for name in fields ]
+        pk_column = qn(opts.pk.column)
+
+        # a WHEN (pk and value) per record per field, plus the pk
+        # again in the IN list
+        chunk_size = cls._get_batch_size(2 * len(fields) + 1, records, chunk_size)
+
+        updated = 0
+        cursor = connection.cursor()
+        for chunk in cls._split_list(records, chunk_size):
+            pks = [ opts.pk.get_db_prep_value(r.pk, connection) for r in chunk ]
+            assignments = []
+            params = []
+            for field in fields:
+                case = 'CASE %s %s END' % (pk_column, ' '.join([ 'WHEN %s THEN %s' ] * len(chunk)))
+                if connection.vendor == 'postgresql':
+                    # otherwise all-NULL (or all-string) cases
+                    # come out as text
+                    case = 'CAST(%s AS %s)' % (case, field.db_type(connection))
+                assignments.append('%s = %s' % (qn(field.column), case))
+                for pk, r in zip(pks, chunk):
+                    params.append(pk)
+                    params.append(field.get_db_prep_save(getattr(r, field.attname), connection))
+            params.extend(pks)
+
+            cursor.execute(
+                    'UPDATE %s SET %s WHERE %s IN (%s)' % (
+                        qn(opts.db_table),
+                        ', '.join(assignments),
+                        pk_column,
+                        ', '.join([ '%s' ] * len(chunk)),
+                    ),
+                    params,
+                )
+            updated += cursor.rowcount
+        return updated
+
     # set_and_track_dirty
     # 
     # Along with update_or_create, it's also often useful
@@ -237,31 +1087,49 @@ class ModelTools(object):
     # assume that the fields we're setting aren't hidden
     # behind properties, because we're going to compare them
     # directly. Second, we assume that you will reset the
-    # dirty field list if you manually save the object.
+    # dirty fields if you manually save the object.
     #
     # This part of the process, where we just set fields on
     # the record, does NOT touch the database unless you are
     # using deferred fields, in which case we force a fetch
     # of any field we're trying to set.
     #
+    # The dirty fields are kept as a single integer on the
+    # record, one bit per field (in _meta field order; see
+    # ModelMetadata.dirty_bits), rather than as a list of names.
+    # With many thousands of tracked records that saves a lot
+    # of memory, and a field that is set twice is only
+    # counted once. Attributes that aren't fields can still be
+    # set, but aren't tracked since they can't be saved.
+    #
     # NOTE: we return the record in case you want to save it
     # right away.
     #
     @classmethod
     def set_and_track_dirty(cls, record, attrs):
-        # ensure we have a list of dirty fields; note that
-        # we don't erase an existing list because it might
-        # be dirty fields from a previous invocation
-        if not hasattr(record, '_caxiam_dirty_list'):
-            record._caxiam_dirty_list = []
+        # note that we don't erase existing dirty bits because
+        # they might be from a previous invocation
+        field_bits = ModelMetadata.get(record.__class__).dirty_bits
+        dirty_mask = getattr(record, '_caxiam_dirty_mask', 0)
         for k,v in attrs.iteritems():
             if not hasattr(record, k):
                 raise AttributeError('record type %s does not have attribute %s' % (record.__class__.__name__, k))
             if getattr(record, k) != v:
                 setattr(record, k, v)
-                record._caxiam_dirty_list.append(k)
+                dirty_mask |= field_bits.get(k, 0)
+        record._caxiam_dirty_mask = dirty_mask
         return record
 
+    # the names of the fields marked dirty on a record, in
+    # field order
+    @classmethod
+    def get_dirty_fields(cls, record):
+        dirty_mask = getattr(record, '_caxiam_dirty_mask', 0)
+        if not dirty_mask:
+            return []
+        field_names = ModelMetadata.get(record.__class__).dirty_field_names
+        return [ name for i, name in enumerate(field_names) if dirty_mask & (1 << i) ]
+
     # save the record, but only the dirty fields
     # NOTE: returns the list of fields updated
     @classmethod
@@ -273,31 +1141,75 @@ class ModelTools(object):
             # for new records
             record.save()
             
-            # create an empty dirty list and report we saved
+            # clear the dirty fields and report we saved
             # everything
-            record._caxiam_dirty_list = []
-            return [ f.name for f in record._meta.fields ]  # messy Django-internals stuff
+            record._caxiam_dirty_mask = 0
+            return list(ModelMetadata.get(record.__class__).field_name_list)
             
         if cls.is_dirty(record):
-            # we have a dirty list and it's not empty
-            record.save(update_fields = record._caxiam_dirty_list)
-            
-            # preserve the dirty list as we're going to wipe
-            # it out
-            dirty_list = record._caxiam_dirty_list
-            record._caxiam_dirty_list = []
+            # we have at least one dirty field
+            dirty_list = cls.get_dirty_fields(record)
+            record.save(update_fields = dirty_list)
+            record._caxiam_dirty_mask = 0
             return dirty_list
 
         # nothing is dirty, don't save
         return []
 
+    # the same as save_if_dirty, for a whole list of records
+    # at once; returns a list of the fields saved for each
+    # record, in the same order
+    #
+    # Rather than one UPDATE per record, records are grouped by
+    # model and by the exact set of fields that are dirty, and
+    # each group is written with bulk_update (one UPDATE per
+    # chunk). New records are inserted with bulk_create, one
+    # per model. So after running set_and_track_dirty across
+    # thousands of records, flushing them costs a handful of
+    # queries instead of thousands.
+    #
+    # NOTE: save() is not called and no signals are sent. In
+    # particular, Django can't always tell us the IDs of
+    # records inserted by bulk_create, so on most databases new
+    # records will still have an ID of None afterwards. Do not
+    # save them again; fetch them if you need them.
+    #
+    @classmethod
+    def bulk_save_if_dirty(cls, records, chunk_size = 500):
+        results = []
+        new_records = {}
+        groups = {}
+        for record in records:
+            if record.id == None:
+                new_records.setdefault(record._meta.concrete_model, []).append(record)
+                results.append(list(ModelMetadata.get(record.__class__).field_name_list))
+            elif cls.is_dirty(record):
+                dirty_list = cls.get_dirty_fields(record)
+                groups.setdefault((record._meta.concrete_model, record._caxiam_dirty_mask), []).append((record, dirty_list))
+                results.append(dirty_list)
+            else:
+                results.append([])
+
+        with transaction.atomic():
+            for model_class, model_records in new_records.iteritems():
+                batch_size = cls._get_batch_size(len(ModelMetadata.get(model_class).concrete_fields), model_records, chunk_size)
+                model_class.objects.bulk_create(model_records, batch_size = batch_size)
+            for model_records in groups.itervalues():
+                cls.bulk_update([ r for r, dirty_list in model_records ], model_records[0][1], chunk_size = chunk_size)
+
+        # everything is clean now
+        for record in records:
+            record._caxiam_dirty_mask = 0
+
+        return results
+
     # determine whether a record was marked dirty
     # any record without an ID is automatically dirty (it
     # has never been saved) but if it has an ID, it has to
     # be explicitly marked dirty by set_and_track_dirty
     @classmethod
     def is_dirty(cls, record):
-        return record.id == None or (hasattr(record, '_caxiam_dirty_list') and record._caxiam_dirty_list)
+        return record.id == None or bool(getattr(record, '_caxiam_dirty_mask', 0))
 
     # given a model class and a dictionary of parameters,
     # pass all the ones that are valid field names into the
@@ -318,9 +1230,71 @@ class ModelTools(object):
     #
     @classmethod
     def create_with_extra(cls, model_class, attrs):
+        return cls._create_with_extra(model_class, ModelMetadata.get(model_class).field_names, attrs)
+
+    # same as create_with_extra, for a list of dictionaries;
+    # returns a list of unsaved records in the same order
+    #
+    # The field names are looked up once for the whole list
+    # rather than once per record.
+    #
+    @classmethod
+    def create_many_with_extra(cls, model_class, attrs_list):
+        model_fields = ModelMetadata.get(model_class).field_names
+        return [ cls._create_with_extra(model_class, model_fields, attrs) for attrs in attrs_list ]
 
-        # look up the fieldnames from _meta
-        model_fields = frozenset([ unicode(f.name) for f in model_class._meta.fields ])
+    # the streaming version of create_many_with_extra: reads
+    # dictionaries from any iterable (a csv.DictReader, a
+    # generator over a JSON feed, ...), inserts them in
+    # bulk_create batches of batch_size records, and yields
+    # each record, extra attributes and all, once its batch
+    # has been written
+    #
+    # Only one batch is held in memory at a time, so this is
+    # safe to run over millions of rows:
+    #
+    #   for record in ModelTools.bulk_create_with_extra(Product, csv.DictReader(f)):
+    #       log_import(record.sku, record.source_line)
+    #
+    # NOTE: as with any bulk_create, save() is not called and
+    # no signals are sent, and on most databases the records
+    # will still have an ID of None afterwards. Models using
+    # AutoHashMixin do get their hashes, one query per batch.
+    #
+    # NOTE: this is a generator; nothing is inserted until you
+    # iterate over it, and stopping part-way leaves the rest of
+    # the input unread and uninserted.
+    #
+    @classmethod
+    def bulk_create_with_extra(cls, model_class, rows, batch_size = 500):
+        if batch_size < 1:
+            raise ValueError('batch size must be at least 1, not %r' % batch_size)
+        model_fields = ModelMetadata.get(model_class).field_names
+
+        batch = []
+        for attrs in rows:
+            batch.append(cls._create_with_extra(model_class, model_fields, attrs))
+            if len(batch) >= batch_size:
+                cls._bulk_create_batch(model_class, batch)
+                for record in batch:
+                    yield record
+                batch = []
+
+        if len(batch) > 0:
+            cls._bulk_create_batch(model_class, batch)
+            for record in batch:
+                yield record
+
+    # bulk_create doesn't call save(), so anything save() would
+    # have filled in has to be done here instead
+    @classmethod
+    def _bulk_create_batch(cls, model_class, batch):
+        if issubclass(model_class, AutoHashMixin) and not getattr(model_class, 'AUTOHASH_ALLOW_EMPTY', False):
+            model_class.generate_hashes(batch)
+        model_class.objects.bulk_create(batch)
+
+    @classmethod
+    def _create_with_extra(cls, model_class, model_fields, attrs):
 
         # split the attrs into two dicts
         model_kwargs = {}
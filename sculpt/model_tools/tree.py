@@ -0,0 +1,414 @@
+from django.db import transaction
+from django.db.models import Q
+from sculpt.model_tools.identity_map import IdentityMap
+import threading
+import time
+
+# TreeSnapshot
+#
+# SimpleTreeMixin.fetch_all_children loads a whole tree and
+# links it up through children_list, but once it returns, the
+# only way to answer questions about the tree (who are this
+# node's ancestors? is it under that one? how deep is it?) is
+# to follow parent links, and anything not already linked goes
+# back to the database.
+#
+# A TreeSnapshot is the same tree, loaded with one query, plus
+# the indexes needed to answer those questions without any
+# queries at all:
+#
+#   nodes - every node, by ID
+#   roots - the top-level nodes, in order
+#   depths - each node's depth (roots are 0), by ID
+#   pre_order, post_order - each node's position in a
+#       depth-first walk, by ID; a node is inside another's
+#       subtree exactly when it comes after it in pre-order
+#       and before it in post-order, so is_child_of is a pair
+#       of comparisons
+#   rollups - results of rollup() kept with cache_as, by name
+#
+# Each node also gets the usual children_list (in order) and
+# its parent set to the loaded parent, so templates written
+# for fetch_all_children work unchanged.
+#
+# Anywhere a node is expected, its ID will do as well.
+#
+# NOTE: a snapshot is exactly that; it doesn't see changes
+# made after it was loaded. Nodes whose parent wasn't loaded
+# (because q excluded it) can't be placed in the tree and are
+# left out.
+#
+class TreeSnapshot(object):
+
+    def __init__(self, model_class, nodes, root = None, share_instances = True):
+        self.model = model_class
+        self.nodes = {}
+        self.roots = []
+        self.depths = {}
+        self.pre_order = {}
+        self.post_order = {}
+        self.rollups = {}
+        self._post_order_nodes = []
+
+        # (a snapshot that outlives the request, like the ones
+        # in TreeCache, mustn't hand its nodes to the request's
+        # identity map)
+        identity_map = IdentityMap.get_active() if share_instances else None
+
+        # group the nodes by parent, keeping their order
+        children = {}
+        loaded = {}
+        for n in nodes:
+            if identity_map is not None:
+                n = identity_map.add(n)
+            loaded[n.pk] = n
+            children.setdefault(n.parent_id, []).append(n)
+
+        # the top of the tree: either the given root or every
+        # node without a parent
+        if root is not None:
+            root_pk = getattr(root, 'pk', root)
+            if root_pk in loaded:
+                self.roots = [ loaded[root_pk] ]
+        else:
+            self.roots = children.get(None, [])
+
+        # walk the tree depth-first, with our own stack rather
+        # than recursion so that deep trees can't overflow it;
+        # each entry is a node and whether we're leaving it
+        counter = 0
+        stack = [ (n, 0, False) for n in reversed(self.roots) ]
+        while len(stack) > 0:
+            n, depth, leaving = stack.pop()
+            if leaving:
+                self.post_order[n.pk] = counter
+                self._post_order_nodes.append(n)
+                counter += 1
+                continue
+
+            if n.pk in self.nodes:
+                # a cycle in the data; don't go around again
+                continue
+            self.nodes[n.pk] = n
+            self.depths[n.pk] = depth
+            self.pre_order[n.pk] = counter
+            counter += 1
+
+            n.children_list = children.get(n.pk, [])
+            for child in n.children_list:
+                child.parent = n
+
+            stack.append((n, depth, True))
+            for child in reversed(n.children_list):
+                stack.append((child, depth + 1, False))
+
+    # load a tree (or just the subtree under root) for a model
+    # using SimpleTreeMixin; see SimpleTreeMixin.load_tree
+    @classmethod
+    def load(cls, model_class, root = None, q = None, order_by = None, select_related = None, share_instances = True):
+        if order_by is None:
+            order_by = [ 'display_order' ]
+        elif isinstance(order_by, basestring):
+            order_by = [ order_by ]
+
+        nodes = model_class.objects.all()
+
+        # with a materialized path, a subtree can be picked out
+        # by its path (an indexed prefix match if we have the
+        # root's own path); otherwise we load everything and
+        # only keep what's under the root
+        path_field = getattr(model_class, 'TREE_PATH_FIELD', None)
+        if root is not None and path_field is not None:
+            if hasattr(root, 'pk'):
+                root_path = getattr(root, path_field)
+                if root_path:
+                    nodes = nodes.filter(Q(pk = root.pk) | Q(**{ path_field + '__startswith': root_path + '%s/' % root.pk }))
+            else:
+                nodes = nodes.filter(Q(pk = root) | Q(**{ path_field + '__contains': '/%s/' % root }))
+
+        if q is not None:
+            nodes = nodes.filter(q)
+        nodes = nodes.order_by(*order_by)
+        if select_related is not None:
+            if isinstance(select_related, basestring):
+                select_related = [ select_related ]
+            nodes = nodes.select_related(*select_related)
+
+        return cls(model_class, nodes, root = root, share_instances = share_instances)
+
+    def _get_pk(self, node):
+        return getattr(node, 'pk', node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return self._get_pk(node) in self.nodes
+
+    # every node, in depth-first (pre-order) order
+    def __iter__(self):
+        for root in self.roots:
+            for n in self.iter_subtree(root):
+                yield n
+
+    def get(self, node):
+        return self.nodes.get(self._get_pk(node))
+
+    def get_children(self, node):
+        return self.nodes[self._get_pk(node)].children_list
+
+    def get_parent(self, node):
+        n = self.nodes[self._get_pk(node)]
+        return self.nodes.get(n.parent_id)
+
+    def get_depth(self, node):
+        return self.depths[self._get_pk(node)]
+
+    # same as SimpleTreeMixin.get_parents: closest first,
+    # unless oldest_first
+    def get_parents(self, node, oldest_first = False):
+        ancestors = []
+        n = self.nodes[self._get_pk(node)]
+        while n.parent_id in self.nodes:
+            n = self.nodes[n.parent_id]
+            ancestors.append(n)
+        if oldest_first:
+            ancestors.reverse()
+        return ancestors
+
+    def get_root(self, node):
+        n = self.nodes[self._get_pk(node)]
+        while n.parent_id in self.nodes:
+            n = self.nodes[n.parent_id]
+        return n
+
+    # is node inside candidate's subtree?
+    def is_child_of(self, node, candidate, allow_self = True):
+        pk = self._get_pk(node)
+        candidate_pk = self._get_pk(candidate)
+        if pk == candidate_pk:
+            return allow_self
+        if pk not in self.nodes or candidate_pk not in self.nodes:
+            return False
+        return self.pre_order[candidate_pk] < self.pre_order[pk] and self.post_order[pk] < self.post_order[candidate_pk]
+
+    # the node and its siblings, in order (for a top-level
+    # node, that's the other top-level nodes)
+    def get_siblings(self, node):
+        parent = self.get_parent(node)
+        if parent is None:
+            return self.roots
+        return parent.children_list
+
+    # the nodes under a node (and the node itself, unless
+    # include_self is False), in depth-first order
+    def iter_subtree(self, node, include_self = True):
+        n = self.nodes[self._get_pk(node)]
+        if include_self:
+            yield n
+        stack = list(reversed(n.children_list))
+        while len(stack) > 0:
+            n = stack.pop()
+            yield n
+            stack.extend(reversed(n.children_list))
+
+    # Rolled-up aggregates
+    #
+    # "How many products are in this category, counting all
+    # its subcategories?" is a rollup: a value for each node,
+    # combined with the values of everything below it. The
+    # per-node values usually come from one GROUP BY over
+    # some related table:
+    #
+    #   tree = Category.load_tree()
+    #   counts = tree.rollup(Product.objects.filter(active = True), 'category', Count('pk'))
+    #   counts[category.pk]    # products in category and below
+    #
+    # The values are combined bottom-up in post-order, without
+    # recursion, so tree depth doesn't matter.
+    #
+    # function can be 'sum' (nodes without a value count as
+    # 0), 'min' or 'max' (nodes without a value are skipped,
+    # and a subtree with no values at all gets None), or your
+    # own function, called as function(value, child_results)
+    # with the node's own value (or None) and a list of its
+    # children's results.
+    #
+    # Give cache_as a name to keep the results in rollups, so
+    # that a cached tree (see TreeCache) carries them along and
+    # later calls with the same name don't query again. They
+    # are thrown away with the tree when it changes, but NOT
+    # when the table the values came from does; only cache
+    # values that change along with the tree, or that can be a
+    # little stale.
+    #
+    # Give attribute a name to also set each node's result as
+    # an attribute of that name, for templates.
+    #
+    def rollup(self, queryset, node_field, aggregate, function = 'sum', cache_as = None, attribute = None):
+        if cache_as is not None and cache_as in self.rollups:
+            results = self.rollups[cache_as]
+        else:
+            results = self.aggregate_subtrees(self.fetch_node_values(queryset, node_field, aggregate), function)
+            if cache_as is not None:
+                self.rollups[cache_as] = results
+
+        if attribute is not None:
+            for pk, n in self.nodes.iteritems():
+                setattr(n, attribute, results[pk])
+        return results
+
+    # one GROUP BY over queryset, by node_field (the foreign key
+    # to the tree model), giving a dictionary of node ID to
+    # aggregate value
+    def fetch_node_values(self, queryset, node_field, aggregate):
+        rows = queryset.order_by().values(node_field).annotate(rollup_value = aggregate)
+        return dict([ (row[node_field], row['rollup_value']) for row in rows ])
+
+    # combine a dictionary of node ID to value up the tree; see
+    # rollup
+    def aggregate_subtrees(self, values, function = 'sum'):
+        if function == 'sum':
+            combine = lambda value, child_results: (value or 0) + sum(child_results)
+        elif function in ('min', 'max'):
+            pick = min if function == 'min' else max
+            def combine(value, child_results):
+                candidates = [ v for v in child_results if v is not None ]
+                if value is not None:
+                    candidates.append(value)
+                return pick(candidates) if len(candidates) > 0 else None
+        elif callable(function):
+            combine = function
+        else:
+            raise ValueError('unknown rollup function %r' % function)
+
+        # children always come before their parents in
+        # post-order, so by the time we reach a node all its
+        # children are done
+        results = {}
+        for n in self._post_order_nodes:
+            results[n.pk] = combine(values.get(n.pk), [ results[child.pk] for child in n.children_list if child.pk in results ])
+        return results
+
+
+# TreeCache
+#
+# Navigation menus and category trees are read on nearly every
+# request and change a few times a day, so loading them from
+# scratch every time is a waste. TreeCache keeps a TreeSnapshot
+# per (model, root) in the process and hands the same one out
+# until the tree changes.
+#
+# Changes are tracked with a version number per model, which
+# SimpleTreeMixin bumps whenever a node is saved (including
+# being moved), deleted, moved with move_to or reordered. A
+# cached tree built under an older version is rebuilt the next
+# time someone asks for it, not before.
+#
+# The version is kept in the process, which is only enough if
+# there is one process. Otherwise name a Django cache (from
+# settings.CACHES) that all of them share, on the model:
+#
+#   TREE_CACHE_BACKEND = 'default'
+#
+# and the version will be kept there instead, costing one
+# cache read per get_tree.
+#
+# NOTE: QuerySet.update() and QuerySet.delete() don't go
+# through the model, so call TreeCache.invalidate(model)
+# after using them on a tree.
+#
+# NOTE: cached trees are shared by every request (and thread)
+# in the process; treat the nodes as read-only. Fetch a fresh
+# copy of a node before changing and saving it.
+#
+class TreeCache(object):
+
+    _trees = {}
+    _versions = {}
+    _lock = threading.Lock()
+
+    # the cached tree (or subtree under root, a node or ID) for
+    # a model, loading it if it's missing or out of date
+    @classmethod
+    def get_tree(cls, model_class, root = None):
+        model_class = model_class._meta.concrete_model
+        key = (model_class, getattr(root, 'pk', root))
+
+        # read the version before loading, so a change made
+        # while we're loading makes the result out of date
+        version = cls.get_version(model_class)
+        entry = cls._trees.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        tree = TreeSnapshot.load(model_class, root = root, share_instances = False)
+        with cls._lock:
+            cls._trees[key] = (version, tree)
+        return tree
+
+    @classmethod
+    def get_version(cls, model_class):
+        model_class = model_class._meta.concrete_model
+        backend = cls._get_backend(model_class)
+        if backend is not None:
+            version = backend.get(cls._get_version_key(model_class))
+            if version is None:
+                # nothing there yet (or it was evicted); start
+                # one, but if someone else beat us to it use theirs
+                backend.add(cls._get_version_key(model_class), cls._get_new_version(), None)
+                version = backend.get(cls._get_version_key(model_class), 0)
+            return version
+        return cls._versions.get(model_class, 0)
+
+    # mark every cached tree for a model as out of date
+    #
+    # If we're inside a transaction, the change isn't visible
+    # to anyone else until it commits, and another process
+    # could rebuild from the old data in the meantime, so (on
+    # Django versions with on_commit) the version is bumped
+    # again when it does.
+    #
+    @classmethod
+    def invalidate(cls, model_class):
+        model_class = model_class._meta.concrete_model
+        cls._bump(model_class)
+        if hasattr(transaction, 'on_commit') and transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: cls._bump(model_class))
+
+    # throw away every cached tree in this process
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._trees.clear()
+
+    @classmethod
+    def _bump(cls, model_class):
+        backend = cls._get_backend(model_class)
+        if backend is not None:
+            try:
+                backend.incr(cls._get_version_key(model_class))
+            except ValueError:
+                # the key isn't there (evicted?), so start again
+                backend.set(cls._get_version_key(model_class), cls._get_new_version(), None)
+        with cls._lock:
+            cls._versions[model_class] = cls._versions.get(model_class, 0) + 1
+
+    # a starting version for the shared cache; based on the
+    # clock, so that a version lost from the cache can't come
+    # back and match a tree some process built long ago
+    @classmethod
+    def _get_new_version(cls):
+        return int(time.time() * 1000)
+
+    @classmethod
+    def _get_backend(cls, model_class):
+        backend = getattr(model_class, 'TREE_CACHE_BACKEND', None)
+        if backend is None:
+            return None
+        from django.core.cache import caches
+        return caches[backend]
+
+    @classmethod
+    def _get_version_key(cls, model_class):
+        return 'sculpt.tree_version:%s.%s' % (model_class._meta.app_label, model_class._meta.model_name)